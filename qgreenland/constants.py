@@ -7,13 +7,32 @@ from qgreenland.util.config import make_config
 PROJECT = 'qgreenland'
 
 ENVIRONMENT = os.environ.get('ENVIRONMENT', 'dev')
+# By default, intermediate rasters which only feed a later step are written as
+# VRTs referencing their source. Set this to write full GeoTIFFs instead, e.g.
+# to inspect them while debugging.
+MATERIALIZE_WIP = bool(os.environ.get('QGREENLAND_MATERIALIZE_WIP'))
 
 PACKAGE_DIR = os.path.dirname(os.path.realpath(__file__))
 PROJECT_DIR = os.path.abspath(os.path.join(PACKAGE_DIR, os.pardir))
 INPUT_DIR = '/input'
+# Downloads are staged here until complete. Partial downloads are kept between
+# runs so they can be resumed.
+INPUT_STAGING_DIR = f'{INPUT_DIR}/.staging'
+# Content-addressed store of all fetched files. See `qgreenland.util.input_cache`.
+INPUT_CACHE_DIR = f'{INPUT_DIR}/.cache'
+# Cached CMR granule lookups. See `qgreenland.util.cmr`.
+CMR_CACHE_DIR = f'{INPUT_DIR}/.cmr_cache'
+# Location of the cache of built layers shared between machines, e.g. a
+# directory on NFS. Unset to disable. See `qgreenland.util.build_cache`.
+BUILD_CACHE = os.environ.get('QGREENLAND_BUILD_CACHE')
 DATA_DIR = '/luigi/data'
 RELEASES_DIR = f'{DATA_DIR}/release'
 WIP_DIR = f'{DATA_DIR}/luigi-wip'
+# WIP outputs shared by all layers using a data source, keyed by data source.
+SOURCES_WIP_DIR = f'{WIP_DIR}/_sources'
+# Fingerprints of the config and code each task's output was built with. See
+# `qgreenland.util.fingerprint`.
+FINGERPRINTS_DIR = f'{WIP_DIR}/fingerprints'
 ASSETS_DIR = f'{PACKAGE_DIR}/assets'
 if 'dev' in __version__:
     RELEASE_DIR = f'{RELEASES_DIR}/dev/{__version__}'
@@ -33,6 +52,12 @@ TMP_DIR = WIP_DIR
 ZIP_TRIGGERFILE = os.path.join(WIP_DIR, 'READY_TO_ZIP')
 
 REQUEST_TIMEOUT = 20
+# Downloads are streamed to disk in chunks of this many bytes, so memory use
+# does not grow with the size of the file being fetched.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Per-dataset fetch concurrency (`fetch_concurrency` in datasets.yml) is
+# further limited to this many simultaneous connections to any one host.
+MAX_CONNECTIONS_PER_HOST = 4
 
 # URS stuff
 URS_COOKIE = 'urs_user_already_logged'
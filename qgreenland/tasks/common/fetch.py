@@ -1,12 +1,13 @@
 import os
 import shutil
+from contextlib import contextmanager
 
 import luigi
 
-from qgreenland.constants import ASSETS_DIR, TaskType
+from qgreenland.constants import ASSETS_DIR, INPUT_STAGING_DIR, TaskType
+from qgreenland.util import input_cache
 from qgreenland.util.cmr import get_cmr_granule
-from qgreenland.util.edl import create_earthdata_authenticated_session as make_session
-from qgreenland.util.misc import fetch_and_write_file, temporary_path_dir
+from qgreenland.util.misc import fetch_and_write_files, temporary_path_dir
 
 
 class FetchTask(luigi.Task):
@@ -17,10 +18,50 @@ class FetchTask(luigi.Task):
     def output_name(self):
         return f"{self.dataset_cfg['id']}.{self.source_cfg['id']}"
 
+    @property
+    def staging_dir(self):
+        return os.path.join(INPUT_STAGING_DIR, self.output_name)
 
-class FetchCmrGranule(FetchTask):
-    session = None
+    @property
+    def fetch_concurrency(self):
+        return self.dataset_cfg.get('fetch_concurrency', 1)
+
+    @property
+    def source_signature(self):
+        return input_cache.source_signature(
+            luigi.DictParameter().serialize(self.source_cfg)
+        )
+
+    def complete(self):
+        # Output fetched with a different source configuration, e.g. before a
+        # URL was changed, is stale.
+        return super().complete() and input_cache.source_is_current(
+            self.output_name,
+            self.source_signature
+        )
+
+    @contextmanager
+    def temporary_output_dir(self, *, urls=()):
+        """Yield a temporary directory which replaces the output on success.
+
+        Also records the source configuration and fetched `urls` in the input
+        cache manifest.
+        """
+        if os.path.exists(self.output().path):
+            # The existing output is stale.
+            shutil.rmtree(self.output().path)
 
+        with temporary_path_dir(self.output()) as temp_path:
+            yield temp_path
+
+        # All files have been promoted to the output directory.
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+        input_cache.record_source(self.output_name,
+                                  self.source_signature,
+                                  urls=urls)
+
+
+class FetchCmrGranule(FetchTask):
     def output(self):
         path = [TaskType.FETCH.value, self.output_name]
         if 'subdir_path' in self.source_cfg:
@@ -33,12 +74,11 @@ class FetchCmrGranule(FetchTask):
             granule_ur=self.source_cfg['granule_ur'],
             collection_concept_id=self.source_cfg['collection_concept_id'])
 
-        with temporary_path_dir(self.output()) as temp_path:
-            for url in granule.urls:
-                if not self.session:
-                    self.session = make_session(hosts=[url])
-
-                fetch_and_write_file(url, output_dir=temp_path, session=self.session)
+        with self.temporary_output_dir(urls=granule.urls) as temp_path:
+            fetch_and_write_files(granule.urls,
+                                  output_dir=temp_path,
+                                  staging_dir=self.staging_dir,
+                                  max_workers=self.fetch_concurrency)
 
 
 class FetchDataFiles(FetchTask):
@@ -53,9 +93,12 @@ class FetchDataFiles(FetchTask):
         if 'cmr' in self.source_cfg:
             raise RuntimeError('Use a FetchCmrGranule task!')
 
-        with temporary_path_dir(self.output()) as temp_path:
-            for url in self.source_cfg['urls']:
-                fetch_and_write_file(url, output_dir=temp_path)
+        urls = self.source_cfg['urls']
+        with self.temporary_output_dir(urls=urls) as temp_path:
+            fetch_and_write_files(urls,
+                                  output_dir=temp_path,
+                                  staging_dir=self.staging_dir,
+                                  max_workers=self.fetch_concurrency)
 
 
 class FetchLocalDataFiles(FetchTask):
@@ -67,7 +110,7 @@ class FetchLocalDataFiles(FetchTask):
         )
 
     def run(self):
-        with temporary_path_dir(self.output()) as temp_path:
+        with self.temporary_output_dir() as temp_path:
             for filename in self.source_cfg['urls']:
                 source_path = os.path.join(ASSETS_DIR, 'local_data', filename)
                 out_path = os.path.join(temp_path, os.path.basename(filename))
@@ -1,105 +1,307 @@
 """common.py: Tasks that could apply to any type of dataproduct."""
-import gzip
+import hashlib
 import logging
 import os
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
 
 import luigi
 import rarfile
 from osgeo import gdal
 
-from qgreenland.constants import TaskType
-from qgreenland.util.luigi import LayerTask
-from qgreenland.util.misc import (find_in_dir_by_ext,
+from qgreenland.constants import (
+    CONFIG,
+    MATERIALIZE_WIP,
+    SOURCES_WIP_DIR
+)
+from qgreenland.util.fingerprint import FingerprintMixin
+from qgreenland.util.luigi import cpus_per_worker
+from qgreenland.util.misc import (extract_members,
+                                  find_in_dir_by_ext,
                                   find_single_file_by_ext,
+                                  gunzip_file,
                                   temporary_path_dir)
 
 
 logger = logging.getLogger('luigi-interface')
 
 
-class Decompress(LayerTask):
-    task_type = TaskType.WIP
+# Files which are read along with a file of each type.
+SIDECAR_EXTS = {
+    '.shp': ('.shp', '.shx', '.dbf', '.prj', '.cpg', '.qix', '.sbn', '.sbx'),
+    '.tif': ('.tif', '.tiff', '.tfw', '.ovr', '.aux.xml'),
+}
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.decompress_kwargs = self.layer_cfg.get('decompress_kwargs', {})
+
+def _split_ext(name):
+    """Split `name` in to a stem and an extension, keeping e.g. `.aux.xml`."""
+    lower_name = name.lower()
+    for exts in SIDECAR_EXTS.values():
+        for ext in exts:
+            if lower_name.endswith(ext):
+                return name[:-len(ext)], ext
+
+    stem, ext = os.path.splitext(name)
+    return stem, ext.lower()
+
+
+def _layer_input_pattern(layer_cfg):
+    """Return the (stem, extensions) of the files a layer is built from.
+
+    `stem` is None when any file with a matching extension will do.
+    """
+    input_filename = layer_cfg.get('ogr2ogr_kwargs', {}).get('input_filename')
+    if input_filename:
+        stem, ext = _split_ext(input_filename)
+        return stem, SIDECAR_EXTS.get(ext, (ext,))
+
+    if 'translate_kwargs' in layer_cfg:
+        return None, ('.nc',)
+
+    if layer_cfg['data_type'] == 'vector':
+        # Vector tasks read shapefiles unless given an `input_filename`.
+        return None, SIDECAR_EXTS['.shp']
+
+    file_type = layer_cfg['file_type']
+    return None, SIDECAR_EXTS.get(file_type, (file_type,))
+
+
+def _matches_layer_input(layer_cfg, name):
+    """Check whether file `name` may be an input of the layer."""
+    member_stem, member_ext = _split_ext(name)
+    stem, exts = _layer_input_pattern(layer_cfg)
+
+    return member_ext in exts and stem in (None, member_stem)
+
+
+class Decompress(FingerprintMixin, luigi.Task):
+    """Decompress the files fetched for `data_source`.
+
+    Keyed by data source and decompression options rather than by layer, so
+    layers sharing a source also share its decompressed files.
+    """
+
+    requires_task = luigi.Parameter()
+    # Reference to a data source in datasets.yml (`{dataset_id}.{source_id}`)
+    data_source = luigi.Parameter()
+    decompress_kwargs = luigi.DictParameter(default={})
+
+    def requires(self):
+        return self.requires_task
 
     def output(self):
-        return luigi.LocalTarget(f'{self.outdir}/decompress/')
+        dirname = 'decompress'
+        if self.decompress_kwargs:
+            # Layers may extract different files from the same source.
+            digest = hashlib.sha256(
+                self._kwargs_str(self.decompress_kwargs).encode('utf-8')
+            ).hexdigest()
+            dirname = f'decompress-{digest[:12]}'
+
+        return luigi.LocalTarget(
+            os.path.join(SOURCES_WIP_DIR, self.data_source, dirname)
+        )
+
+    @staticmethod
+    def _kwargs_str(kwargs):
+        return luigi.DictParameter().serialize(kwargs)
+
+    @property
+    def layer_cfgs(self):
+        """Return the config of each layer which uses this task's output."""
+        kwargs_str = self._kwargs_str(self.decompress_kwargs)
+        return [
+            layer_cfg for layer_cfg in CONFIG['layers'].values()
+            if layer_cfg['data_source'] == self.data_source
+            and self._kwargs_str(
+                layer_cfg.get('decompress_kwargs', {})
+            ) == kwargs_str
+        ]
+
+    def fingerprint_config(self):
+        # The files extracted depend on the inputs of the layers using them.
+        return {
+            **super().fingerprint_config(),
+            'layer_inputs': sorted(
+                (layer_cfg['id'], _layer_input_pattern(layer_cfg))
+                for layer_cfg in self.layer_cfgs
+            ),
+        }
+
+    def select_member(self, name):
+        """Check whether archive member `name` is needed by any layer."""
+        if 'extract_files' in self.decompress_kwargs:
+            return name in self.decompress_kwargs['extract_files']
+
+        return any(
+            _matches_layer_input(layer_cfg, name) for layer_cfg in self.layer_cfgs
+        )
+
+    def check_extracted(self, archive_path, extracted):
+        """Check `extracted` has every file the layers using it need."""
+        if 'extract_files' in self.decompress_kwargs:
+            missing = set(self.decompress_kwargs['extract_files']) - set(extracted)
+            if missing:
+                raise RuntimeError(
+                    f'{archive_path} does not contain: {sorted(missing)}'
+                )
+            return
+
+        if not any(self.select_member(name) for name in extracted):
+            # Nothing was selected, so everything was extracted.
+            return
+
+        for layer_cfg in self.layer_cfgs:
+            if not any(_matches_layer_input(layer_cfg, n) for n in extracted):
+                stem, exts = _layer_input_pattern(layer_cfg)
+                raise RuntimeError(
+                    f"{archive_path} has no input for layer '{layer_cfg['id']}'"
+                    f" (name: {stem or '*'}, extensions: {list(exts)})."
+                )
+
+    def extract_archive(self, *, ext, open_archive):
+        archive_path = find_single_file_by_ext(self.input().path, ext=ext)
+
+        with temporary_path_dir(self.output()) as temp_path:
+            extracted = extract_members(archive_path, temp_path,
+                                        open_archive=open_archive,
+                                        select=self.select_member,
+                                        max_workers=cpus_per_worker())
+            self.check_extracted(archive_path, extracted)
 
 
 class UngzipMany(Decompress):
     def run(self):
         gzip_paths = find_in_dir_by_ext(self.input().path, ext='.gz')
-        with temporary_path_dir(self.output()) as temp_path:
+        max_workers = max(1, min(len(gzip_paths), cpus_per_worker()))
+
+        # Decompression is CPU-bound, so use processes rather than threads.
+        with temporary_path_dir(self.output()) as temp_path, \
+                ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
             for gzip_path in gzip_paths:
-                with gzip.open(gzip_path, 'rb') as gf:
-                    decompress_filename = os.path.basename(gzip_path).replace('.gz', '')
-                    decompress_filepath = os.path.join(temp_path, decompress_filename)
-                    with open(decompress_filepath, 'wb') as f:
-                        f.write(gf.read())
+                decompress_filename = os.path.basename(gzip_path)[:-len('.gz')]
+                decompress_filepath = os.path.join(temp_path, decompress_filename)
+                futures.append(
+                    executor.submit(gunzip_file, gzip_path, decompress_filepath)
+                )
+
+            for future in futures:
+                future.result()
 
 
 class Unrar(Decompress):
     def run(self):
-        rar_path = find_single_file_by_ext(self.input().path, ext='.rar')
-        rf = rarfile.RarFile(rar_path)
-
-        with temporary_path_dir(self.output()) as temp_path:
-            if 'extract_file' in self.decompress_kwargs:
-                rf.extract(self.decompress_kwargs['extract_file'],
-                           path=temp_path)
-            else:
-                rf.extractall(path=temp_path)
-
-            rf.close()
+        self.extract_archive(ext='.rar', open_archive=rarfile.RarFile)
 
 
 class Unzip(Decompress):
     def run(self):
-        zf_path = find_single_file_by_ext(self.input().path, ext='.zip')
-        zf = zipfile.ZipFile(zf_path)
+        self.extract_archive(ext='.zip', open_archive=zipfile.ZipFile)
 
-        with temporary_path_dir(self.output()) as temp_path:
-            if 'extract_files' in self.decompress_kwargs:
-                for extract_file in self.decompress_kwargs['extract_files']:
-                    zf.extract(extract_file, path=temp_path)
-            else:
-                # zf.extractall instead???
-                for fn in zf.namelist():
-                    zf.extract(fn, temp_path)
 
-            zf.close()
+def extract_nc_dataset(input_fp, layer_cfg, output_dir):
+    """Extract the NetCDF variable in a layer's `translate_kwargs`.
+
+    Writes `{layer_id}{ext}` in `output_dir`.
+    """
+    # Don't modify the shared config; it may be needed by another task in
+    # this process.
+    translate_kwargs = dict(layer_cfg['translate_kwargs'])
+    dataset_name = translate_kwargs.pop('extract_dataset')
+
+    if MATERIALIZE_WIP:
+        output_ext = layer_cfg['file_type']
+    else:
+        output_ext = '.vrt'
+        translate_kwargs['format'] = 'VRT'
+
+    output_fp = os.path.join(output_dir, f"{layer_cfg['id']}{output_ext}")
+
+    # The VRT is moved in to place after it's written, so it must reference
+    # the input by absolute path.
+    from_dataset_path = f'NETCDF:{os.path.abspath(input_fp)}:{dataset_name}'
+    logger.debug(
+        f'Using gdal.Translate to convert from {from_dataset_path} to {output_fp}'
+    )
 
+    result = gdal.Translate(
+        output_fp,
+        from_dataset_path,
+        **translate_kwargs
+    )
+    if result is None:
+        raise RuntimeError(f'Failed to extract {from_dataset_path}.')
 
-class ExtractNcDataset(LayerTask):
-    """Extracts dataset `dataset_name` from input .nc file."""
 
-    task_type = TaskType.WIP
+class ExtractNcDataset(FingerprintMixin, luigi.Task):
+    """Extract the NetCDF variables used by each layer of `data_source`.
+
+    Layers often use several variables (or bands) of one NetCDF file, so they
+    share this task rather than each scanning the file. Writes one file per
+    layer, `{layer_id}{ext}`, from the layer's `translate_kwargs`.
+
+    Unless `MATERIALIZE_WIP` is set, the outputs are VRTs which reference the
+    input, so the data is only read when the next task (e.g. a warp) runs.
+    Otherwise, the variables are translated in parallel processes; GDAL reads
+    each in blocks matching the file's internal chunking.
+    """
+
+    requires_task = luigi.Parameter()
+    # Reference to a data source in datasets.yml (`{dataset_id}.{source_id}`)
+    data_source = luigi.Parameter()
+    resources = {'memory_gb': 1}
+
+    def requires(self):
+        return self.requires_task
+
+    @property
+    def layer_cfgs(self):
+        return [
+            layer_cfg for layer_cfg in CONFIG['layers'].values()
+            if layer_cfg['data_source'] == self.data_source
+            and 'translate_kwargs' in layer_cfg
+        ]
+
+    def fingerprint_config(self):
+        return {
+            **super().fingerprint_config(),
+            'layer_datasets': {
+                layer_cfg['id']: (layer_cfg['translate_kwargs'],
+                                  layer_cfg['file_type'])
+                for layer_cfg in self.layer_cfgs
+            },
+            'materialize_wip': MATERIALIZE_WIP,
+        }
 
     def output(self):
-        # GDAL translate will automatically determine file type from the extension.
         return luigi.LocalTarget(
-            os.path.join(self.outdir, 'extract')
+            os.path.join(SOURCES_WIP_DIR, self.data_source, 'extract')
         )
 
     def run(self):
-        with temporary_path_dir(self.output()) as temp_dir:
-            input_fp = find_single_file_by_ext(self.input().path, ext='.nc')
-
-            dataset_name = self.layer_cfg['translate_kwargs'].pop('extract_dataset')
-
-            output_filename = f"{dataset_name}{self.layer_cfg['file_type']}"
-            output_fp = os.path.join(temp_dir, output_filename)
-
-            from_dataset_path = f'NETCDF:{input_fp}:{dataset_name}'
-            logger.debug(
-                f'Using gdal.Translate to convert from {from_dataset_path} to {output_fp}'
+        input_fp = find_single_file_by_ext(self.input().path, ext='.nc')
+        layer_cfgs = self.layer_cfgs
+        if not layer_cfgs:
+            raise RuntimeError(
+                f'No layers with translate_kwargs use {self.data_source}.'
             )
 
-            gdal.Translate(
-                output_fp,
-                from_dataset_path,
-                **self.layer_cfg['translate_kwargs']
-            )
+        with temporary_path_dir(self.output()) as temp_dir:
+            if not MATERIALIZE_WIP or len(layer_cfgs) == 1:
+                # Writing VRTs doesn't read the data.
+                for layer_cfg in layer_cfgs:
+                    extract_nc_dataset(input_fp, layer_cfg, temp_dir)
+                return
+
+            # GDAL's netCDF driver allows only one thread at a time to read,
+            # so use processes.
+            max_workers = max(1, min(len(layer_cfgs), cpus_per_worker()))
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    executor.submit(extract_nc_dataset,
+                                    input_fp, layer_cfg, temp_dir)
+                    for layer_cfg in layer_cfgs
+                ]
+                for future in futures:
+                    future.result()
@@ -2,58 +2,64 @@ import os
 import shutil
 
 import luigi
-import rasterio as rio
 
 from qgreenland.constants import CONFIG, TaskType
-from qgreenland.util.luigi import LayerTask
-from qgreenland.util.misc import find_single_file_by_ext, temporary_path_dir
-from qgreenland.util.raster import gdal_calc_raster, warp_raster
+from qgreenland.util.luigi import LayerTask, cpus_per_worker
+from qgreenland.util.misc import (
+    find_in_dir_by_ext,
+    link_or_copy_file,
+    temporary_path_dir
+)
+from qgreenland.util.raster import (
+    OVERVIEW_RESAMPLING_METHODS,
+    build_overviews,
+    has_overviews,
+    merge_warp_options,
+    warp_raster
+)
+from qgreenland.util.raster_calc import calc_raster
 
 
 class BuildRasterOverviews(LayerTask):
     task_type = TaskType.WIP
+    default_resources = {'memory_gb': 1}
+    # Long-running; start these early so they don't hold up the end of a run.
+    default_priority = 10
 
     def output(self):
         return luigi.LocalTarget(os.path.join(self.outdir, 'overviews'))
 
     def run(self):
-        # TODO: Extract this to LayerTask as a property?
-        # TODO: Find in dir by self.filename instead? Wouldn't work if the
-        #       upstream task was e.g. unzip
-        ifile = find_single_file_by_ext(self.input().path,
-                                        ext=self.layer_cfg['file_type'])
-
-        overviews_kwargs = {
-            'overview_levels': (2, 4, 8, 16),
-            'resampling_method': 'average'
-        }
-
-        overviews_kwargs.update(
-            self.layer_cfg.get('overviews_kwargs', {})
-        )
+        ifile = self.find_input_file(ext=self.layer_cfg['file_type'])
 
-        overview_levels = overviews_kwargs['overview_levels']
-        resampling_str = overviews_kwargs['resampling_method']
-
-        try:
-            resampling_method = rio.enums.Resampling[resampling_str]
-        except KeyError:
+        overviews_kwargs = self.layer_cfg.get('overviews_kwargs', {})
+        resampling_method = overviews_kwargs.get('resampling_method', 'average')
+        if resampling_method.upper() not in OVERVIEW_RESAMPLING_METHODS:
             raise RuntimeError(
-                f"'{resampling_str}' is not a valid resampling method."
+                f"'{resampling_method}' is not a valid resampling method."
             )
 
         with temporary_path_dir(self.output()) as tmp_dir:
             tmp_path = os.path.join(tmp_dir, self.filename)
-            # Copy the existing file into place. Currently, this task creates
-            # 'internal overviews', which changes the file itself.
-            shutil.copy2(ifile, tmp_path)
+            if has_overviews(ifile):
+                # COGs (see `cog_kwargs`) are written with overviews. Link the
+                # upstream file in to place instead of copying it.
+                link_or_copy_file(ifile, tmp_path)
+                return
 
-            with rio.open(tmp_path, 'r+') as ds:
-                ds.build_overviews(overview_levels, resampling_method)
+            # Overviews are built inside the file, so it must be a copy.
+            shutil.copy2(ifile, tmp_path)
+            build_overviews(
+                tmp_path,
+                levels=overviews_kwargs.get('overview_levels'),
+                resampling=resampling_method,
+            )
 
 
 class WarpRaster(LayerTask):
     task_type = TaskType.WIP
+    default_resources = {'memory_gb': 2}
+    default_priority = 10
     input_ext_override = luigi.Parameter(default=None)
 
     def output(self):
@@ -68,38 +74,61 @@ class WarpRaster(LayerTask):
 
         extent_str = self.layer_cfg.get('extent', 'background')
         extent = CONFIG['project']['extents'][extent_str]
+        project_warp_kwargs = CONFIG['project'].get('warp_kwargs', {})
+        layer_warp_kwargs = self.layer_cfg.get('warp_kwargs', {})
         warp_kwargs = {
             'resampleAlg': 'bilinear',
             'outputBounds': list(extent.values()),
-            'creationOptions': ['COMPRESS=DEFLATE']
+            'creationOptions': ['COMPRESS=DEFLATE'],
+            **project_warp_kwargs,
+            **layer_warp_kwargs,
+            # Layers add to, rather than replace, the project's warp options.
+            'warpOptions': merge_warp_options(
+                [f'NUM_THREADS={cpus_per_worker()}'],
+                project_warp_kwargs.get('warpOptions', []),
+                layer_warp_kwargs.get('warpOptions', []),
+            ),
         }
-        if 'warp_kwargs' in self.layer_cfg:
-            warp_kwargs.update(self.layer_cfg['warp_kwargs'])
 
         file_ext = self.input_ext_override or self.layer_cfg['file_type']
-        inp_path = find_single_file_by_ext(self.input().path, ext=file_ext)
+        if find_in_dir_by_ext(self.input().path, ext='.vrt'):
+            # The upstream task deferred its work to this one.
+            file_ext = '.vrt'
+        inp_path = self.find_input_file(ext=file_ext)
 
         with temporary_path_dir(self.output()) as tmp_dir:
             out_path = os.path.join(tmp_dir, self.filename)
             warp_raster(inp_path, out_path,
                         layer_cfg=self.layer_cfg,
-                        warp_kwargs=warp_kwargs)
+                        warp_kwargs=warp_kwargs,
+                        cog_kwargs=self.layer_cfg.get('cog_kwargs'))
 
 
 class GdalCalcRaster(LayerTask):
 
     task_type = TaskType.WIP
+    default_resources = {'memory_gb': 1}
     input_ext_override = luigi.Parameter(default=None)
 
     def output(self):
         return luigi.LocalTarget(os.path.join(self.outdir, 'calc'))
 
     def run(self):
+        gdal_calc_kwargs = self.layer_cfg['gdal_calc_kwargs']
+        if 'inputs' in gdal_calc_kwargs:
+            input_fps = {
+                name: os.path.join(self.input().path, fn)
+                for name, fn in gdal_calc_kwargs['inputs'].items()
+            }
+        else:
+            input_fps = {
+                'A': self.find_input_file(ext=self.layer_cfg['file_type'])
+            }
+
         with temporary_path_dir(self.output()) as tmp_dir:
             out_path = os.path.join(tmp_dir, self.filename)
-            inp_path = find_single_file_by_ext(self.input().path,
-                                               ext=self.layer_cfg['file_type'])
-            gdal_calc_kwargs = self.layer_cfg['gdal_calc_kwargs']
-            gdal_calc_raster(inp_path, out_path,
-                             layer_cfg=self.layer_cfg,
-                             gdal_calc_kwargs=gdal_calc_kwargs)
+            calc_raster(input_fps, out_path,
+                        calc=gdal_calc_kwargs['calc'],
+                        output_type=gdal_calc_kwargs.get('type'),
+                        nodata=gdal_calc_kwargs.get('NoDataValue'),
+                        max_workers=cpus_per_worker())
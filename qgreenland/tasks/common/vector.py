@@ -5,34 +5,61 @@ import luigi
 
 from qgreenland.constants import CONFIG, TaskType
 from qgreenland.util.luigi import LayerTask
-from qgreenland.util.misc import find_single_file_by_ext, temporary_path_dir
-from qgreenland.util.vector import filter_vector, ogr2ogr
+from qgreenland.util.misc import (
+    find_in_dir_by_ext,
+    temporary_path_dir
+)
+from qgreenland.util.vector import extent_filter_kwargs, filter_vector, ogr2ogr
 
 logger = logging.getLogger('luigi-interface')
 
+# ogr2ogr options for each supported output `file_type`.
+OUTPUT_FORMAT_KWARGS = {
+    # Output an UTF-8 encoded shapefile instead of default ISO-8859-1
+    '.shp': {'f': '"ESRI Shapefile"', 'lco': 'ENCODING=UTF-8'},
+    # Build the R-tree spatial index as features are written.
+    '.gpkg': {'f': 'GPKG', 'lco': 'SPATIAL_INDEX=YES'},
+    '.geojson': {'f': 'GeoJSON'},
+}
+
+
+def _output_format_kwargs(layer_cfg):
+    file_type = layer_cfg['file_type']
+    try:
+        format_kwargs = dict(OUTPUT_FORMAT_KWARGS[file_type])
+    except KeyError:
+        raise RuntimeError(
+            f"Unsupported vector file_type '{file_type}'. Must be one of:"
+            f' {list(OUTPUT_FORMAT_KWARGS)}.'
+        )
+
+    if file_type == '.gpkg':
+        # Name the table after the layer rather than the input or SQL query.
+        format_kwargs['nln'] = layer_cfg['id']
+
+    return format_kwargs
+
 
-# TODO: Make more generic -- filter vector features, don't assume .shp
-# TODO: Use Ogr2OgrVector to filter with sql instead of lambda?
 class FilterShapefileFeatures(LayerTask):
-    """Expects a shapefile as input and writes a shapefile out."""
+    """Filter a shapefile's features with the layer's `filter_kwargs`.
+
+    Writes the layer's `file_type`.
+    """
 
     task_type = TaskType.WIP
-    filter_func = luigi.Parameter()
 
     def output(self):
         return luigi.LocalTarget(f'{self.outdir}/filter/')
 
     def run(self):
         logger.info(f"Filtering {self.layer_cfg['id']}...")
-        shapefile = find_single_file_by_ext(self.input().path, ext='.shp')
-        gdf = filter_vector(
-            shapefile,
-            filter_func=self.filter_func
-        )
+        shapefile = self.find_input_file(ext='.shp')
 
         with temporary_path_dir(self.output()) as temp_path:
             fn = os.path.join(temp_path, self.filename)
-            gdf.to_file(fn, driver='ESRI Shapefile')
+            filter_vector(shapefile, fn,
+                          filter_kwargs=self.layer_cfg['filter_kwargs'],
+                          **_output_format_kwargs(self.layer_cfg))
 
 
 class Ogr2OgrVector(LayerTask):
@@ -52,8 +79,9 @@ class Ogr2OgrVector(LayerTask):
         clipdst = ('"{xmin}" "{ymin}" '
                    '"{xmax}" "{ymax}"').format(**extent)  # noqa: FS002
         ogr2ogr_kwargs = {
-            # Output an UTF-8 encoded shapefile instead of default ISO-8859-1
-            'lco': 'ENCODING=UTF-8',
+            # Fix invalid geometries before they're reprojected and clipped.
+            'makevalid': '',
+            **_output_format_kwargs(self.layer_cfg),
             't_srs': CONFIG['project']['crs'],
             # As opposed to `clipsrc`, `clipdst` uses the destination SRS
             # (`t_srs`) to clip the input after reprojection.
@@ -66,29 +94,28 @@ class Ogr2OgrVector(LayerTask):
                 self.input().path,
                 ogr2ogr_kwargs.pop('input_filename')
             )
+        elif find_in_dir_by_ext(self.input().path, ext='.shp'):
+            input_filename = self.find_input_file(ext='.shp')
         else:
-            shapefile = find_single_file_by_ext(self.input().path, ext='.shp')
-            input_filename = shapefile
-
-        with temporary_path_dir(self.output()) as temp_path:
-            # Before doing the requested transformation, make the vector data
-            # valid. We have to do the SQL step here because this command will
-            # change the internal table name of the output shapefile.
-            infile = os.path.join(self.input().path, input_filename)
-            # TODO probably need to cleanup this output? Put it in another dir?
-            valid_outfile = os.path.join(
-                temp_path,
-                'valid.shp'
+            # E.g. the output of `FilterShapefileFeatures` for a GeoPackage
+            # layer.
+            input_filename = self.find_input_file(
+                ext=self.layer_cfg['file_type']
             )
-            valid_kwargs = {'makevalid': ''}
-            if 'sql' in ogr2ogr_kwargs:
-                valid_kwargs['sql'] = ogr2ogr_kwargs.pop('sql')
-            ogr2ogr(infile, valid_outfile, **valid_kwargs)
-            infile = valid_outfile
 
-            # Do the requested transformation
+        if 'spat' not in ogr2ogr_kwargs:
+            ogr2ogr_kwargs.update(extent_filter_kwargs(
+                input_filename,
+                extent=extent,
+                s_srs=ogr2ogr_kwargs.get('s_srs'),
+            ))
+
+        with temporary_path_dir(self.output()) as temp_path:
+            # Read only features near the extent, make the geometries valid,
+            # run any SQL, reproject and clip in a single pass, so only the
+            # final output is written.
             outfile = os.path.join(
                 temp_path,
                 self.filename
             )
-            ogr2ogr(infile, outfile, **ogr2ogr_kwargs)
+            ogr2ogr(input_filename, outfile, **ogr2ogr_kwargs)
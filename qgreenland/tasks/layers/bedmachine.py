@@ -20,7 +20,7 @@ class BedMachineDataset(LayerPipeline):
         )  # ->
         extract_nc_dataset = ExtractNcDataset(
             requires_task=fetch_data,
-            layer_id=self.layer_id,
+            data_source=self.cfg['data_source'],
         )  # ->
         return WarpRaster(
             requires_task=extract_nc_dataset,
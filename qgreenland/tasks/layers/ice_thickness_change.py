@@ -14,7 +14,8 @@ class IceThicknessChange(LayerPipeline):
         )  # ->
         unzip = Unzip(
             requires_task=fetch_data,
-            layer_id=self.layer_id,
+            data_source=self.cfg['data_source'],
+            decompress_kwargs=self.cfg.get('decompress_kwargs', {}),
         )  # ->
         return WarpRaster(
             requires_task=unzip,
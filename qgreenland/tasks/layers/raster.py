@@ -13,6 +13,10 @@ class Raster(LayerPipeline):
             requires_task=fetch_data,
             layer_id=self.layer_id
         )  # ->
+        if 'cog_kwargs' in self.cfg:
+            # Cloud-Optimized GeoTIFFs are written with overviews.
+            return warp_raster
+
         return BuildRasterOverviews(
             requires_task=warp_raster,
             layer_id=self.layer_id
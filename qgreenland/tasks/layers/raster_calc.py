@@ -19,6 +19,10 @@ class RasterCalc(LayerPipeline):
             requires_task=gdal_calc,
             layer_id=self.layer_id
         )  # ->
+        if 'cog_kwargs' in self.cfg:
+            # Cloud-Optimized GeoTIFFs are written with overviews.
+            return warp_raster
+
         return BuildRasterOverviews(
             requires_task=warp_raster,
             layer_id=self.layer_id
@@ -17,15 +17,12 @@ class UtmZones(LayerPipeline):
         )  # ->
         unzip = Unzip(
             requires_task=fetch_data,
-            layer_id=self.layer_id
+            data_source=self.cfg['data_source'],
+            decompress_kwargs=self.cfg.get('decompress_kwargs', {}),
         )  # ->
         filter_shapefile = FilterShapefileFeatures(
             requires_task=unzip,
             layer_id=self.layer_id,
-            # The UTM Zones file includes a Zone 0 which overlaps all the other
-            # zones. It looked bad so I removed it. Should we solve this some
-            # other way?
-            filter_func=lambda df: df['ZONE'] != 0,
         )  # ->
         return Ogr2OgrVector(
             requires_task=filter_shapefile,
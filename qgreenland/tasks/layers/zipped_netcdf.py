@@ -14,16 +14,21 @@ class ZippedNetCdf(LayerPipeline):
         )  # ->
         unzip = Unzip(
             requires_task=fetch_data,
-            layer_id=self.layer_id
+            data_source=self.cfg['data_source'],
+            decompress_kwargs=self.cfg.get('decompress_kwargs', {}),
         )  # ->
         extract_nc_dataset = ExtractNcDataset(
             requires_task=unzip,
-            layer_id=self.layer_id,
+            data_source=self.cfg['data_source'],
         )  # ->
         warp_raster = WarpRaster(
             requires_task=extract_nc_dataset,
             layer_id=self.layer_id
         )  # ->
+        if 'cog_kwargs' in self.cfg:
+            # Cloud-Optimized GeoTIFFs are written with overviews.
+            return warp_raster
+
         return BuildRasterOverviews(
             requires_task=warp_raster,
             layer_id=self.layer_id
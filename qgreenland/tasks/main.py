@@ -12,8 +12,13 @@ from qgreenland.constants import (ASSETS_DIR,
                                   TMP_DIR,
                                   TaskType,
                                   ZIP_TRIGGERFILE)
+from qgreenland.util import input_cache
 from qgreenland.util.config import export_config
-from qgreenland.util.misc import cleanup_intermediate_dirs
+from qgreenland.util.fingerprint import FingerprintMixin, file_fingerprint
+from qgreenland.util.misc import (cleanup_intermediate_dirs,
+                                  get_layer_dir,
+                                  prune_final_dir,
+                                  temporary_path)
 from qgreenland.util.qgis import make_qgis_project_file
 from qgreenland.util.task import generate_layer_tasks
 
@@ -28,7 +33,7 @@ class IngestAllLayers(luigi.WrapperTask):
             yield task
 
 
-class AncillaryFile(luigi.Task):
+class AncillaryFile(FingerprintMixin, luigi.Task):
     """Copy an ancillary file in to the final QGreenland package."""
 
     # Absolute path
@@ -36,13 +41,19 @@ class AncillaryFile(luigi.Task):
     # Relative to the root of QGreenland
     dest_relative_filepath = luigi.Parameter()
 
+    def fingerprint_config(self):
+        return {
+            **super().fingerprint_config(),
+            'src': file_fingerprint(self.src_filepath),
+        }
+
     def output(self):
         return luigi.LocalTarget(
             os.path.join(TaskType.FINAL.value, self.dest_relative_filepath)
         )
 
     def run(self):
-        with self.output().temporary_path() as temp_path:
+        with temporary_path(self.output()) as temp_path:
             shutil.copy(self.src_filepath, temp_path)
 
 
@@ -50,13 +61,21 @@ class LayerManifest(AncillaryFile):
     src_filepath = None
     dest_relative_filepath = 'manifest.csv'
 
+    def fingerprint_config(self):
+        return {'config': CONFIG}
+
     def run(self):
-        with self.output().temporary_path() as temp_path:
+        with temporary_path(self.output()) as temp_path:
             export_config(CONFIG, output_path=temp_path)
 
 
-class CreateQgisProjectFile(luigi.Task):
-    """Create .qgz/.qgs project file."""
+class CreateQgisProjectFile(FingerprintMixin, luigi.Task):
+    """Create .qgz/.qgs project file.
+
+    Its output, the zip trigger file, isn't removed after zipping in dev. The
+    fingerprint makes sure it's recreated, and changed layers are rebuilt,
+    when any layer changes.
+    """
 
     def requires(self):
         yield LayerManifest()
@@ -92,24 +111,42 @@ class CreateQgisProjectFile(luigi.Task):
             pass
 
 
-class ZipQGreenland(luigi.Task):
-    """Zip entire QGreenland package for distribution."""
+class ZipQGreenland(FingerprintMixin, luigi.Task):
+    """Zip entire QGreenland package for distribution.
+
+    Rebuilt when any layer or ancillary file changes. Only the tasks whose
+    fingerprints changed are rerun.
+    """
 
     def requires(self):
         return CreateQgisProjectFile()
 
     def output(self):
-        os.makedirs(RELEASE_DIR, exist_ok=True)
         fn = f'{RELEASE_DIR}/QGreenland_{__version__}.zip'
         return luigi.LocalTarget(fn)
 
     def run(self):
+        # Layers removed from the config since the last build may still be
+        # on disk.
+        prune_final_dir(
+            layer_dirs=[get_layer_dir(cfg) for cfg in CONFIG['layers'].values()]
+        )
+
         tmp_name = f'{TMP_DIR}/final_archive'
         shutil.make_archive(tmp_name, 'zip', TMP_DIR, 'qgreenland')
 
+        os.makedirs(RELEASE_DIR, exist_ok=True)
         os.rename(f'{tmp_name}.zip', self.output().path)
 
         os.remove(self.input().path)
 
+        input_cache.log_stats()
+
         if ENVIRONMENT != 'dev':
-            cleanup_intermediate_dirs(delete_fetch_dir=False)
+            # Keep the final layers so the next release only rebuilds those
+            # which changed.
+            cleanup_intermediate_dirs(delete_fetch_dir=False,
+                                      delete_final_dir=False)
+            input_cache.prune(source_keys={
+                cfg['data_source'] for cfg in CONFIG['layers'].values()
+            })
@@ -0,0 +1,82 @@
+import os
+import zipfile
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import luigi
+import pytest
+
+from qgreenland.constants import CONFIG
+from qgreenland.tasks.common import misc
+from qgreenland.tasks.common.misc import ExtractNcDataset, Unzip
+
+
+def _fake_translate(output_fp, from_dataset_path, **kwargs):
+    with open(output_fp, 'w') as f:
+        f.write(f'{os.getpid()} {from_dataset_path}')
+    return True
+
+
+def _nc_layer_cfg(layer_id, dataset):
+    return {
+        'id': layer_id,
+        'data_source': 'example.nc',
+        'file_type': '.tif',
+        'translate_kwargs': {'extract_dataset': dataset},
+    }
+
+
+def test_extract_nc_dataset_processes(tmp_path, monkeypatch):
+    layers = {
+        'thickness': _nc_layer_cfg('thickness', 'thickness'),
+        'bed': _nc_layer_cfg('bed', 'bed'),
+    }
+    monkeypatch.setitem(CONFIG, 'layers', layers)
+    monkeypatch.setattr(misc, 'MATERIALIZE_WIP', True)
+    monkeypatch.setattr(misc, 'gdal', SimpleNamespace(Translate=_fake_translate))
+    monkeypatch.setattr(misc, 'cpus_per_worker', lambda: 2)
+
+    input_dir = tmp_path / 'input'
+    input_dir.mkdir()
+    (input_dir / 'example.nc').touch()
+    output_dir = tmp_path / 'extract'
+
+    task = ExtractNcDataset(requires_task=None, data_source='example.nc')
+    with patch.object(ExtractNcDataset, 'input',
+                      return_value=luigi.LocalTarget(str(input_dir))), \
+            patch.object(ExtractNcDataset, 'output',
+                         return_value=luigi.LocalTarget(str(output_dir))):
+        task.run()
+
+    for layer_id in layers:
+        pid, source = (output_dir / f'{layer_id}.tif').read_text().split()
+        assert source.endswith(f'example.nc:{layer_id}')
+        # Each dataset is extracted in a worker process.
+        assert int(pid) != os.getpid()
+
+
+def test_unzip_layer_without_input(tmp_path, monkeypatch):
+    monkeypatch.setitem(CONFIG, 'layers', {
+        'roads': {'id': 'roads', 'data_source': 'example.only',
+                  'data_type': 'vector', 'file_type': '.gpkg'},
+        'dem': {'id': 'dem', 'data_source': 'example.only',
+                'data_type': 'raster', 'file_type': '.tif'},
+    })
+
+    input_dir = tmp_path / 'input'
+    input_dir.mkdir()
+    with zipfile.ZipFile(input_dir / 'example.zip', 'w') as zf:
+        zf.writestr('roads.shp', 'shp')
+        zf.writestr('roads.dbf', 'dbf')
+        zf.writestr('readme.txt', 'readme')
+    output_dir = tmp_path / 'decompress'
+
+    task = Unzip(requires_task=None, data_source='example.only')
+    with patch.object(Unzip, 'input',
+                      return_value=luigi.LocalTarget(str(input_dir))), \
+            patch.object(Unzip, 'output',
+                         return_value=luigi.LocalTarget(str(output_dir))):
+        with pytest.raises(RuntimeError, match="layer 'dem'"):
+            task.run()
+
+    assert not output_dir.exists()
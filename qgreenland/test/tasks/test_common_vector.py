@@ -0,0 +1,18 @@
+import pytest
+
+from qgreenland.constants import CONFIG
+from qgreenland.tasks.common.vector import _output_format_kwargs
+
+
+@pytest.mark.parametrize(
+    'layer_cfg',
+    [cfg for cfg in CONFIG['layers'].values() if cfg['file_type'] != '.tif'],
+    ids=lambda cfg: cfg['id'],
+)
+def test_output_format_kwargs_configured_layers(layer_cfg):
+    assert 'f' in _output_format_kwargs(layer_cfg)
+
+
+def test_output_format_kwargs_unsupported():
+    with pytest.raises(RuntimeError):
+        _output_format_kwargs({'id': 'example', 'file_type': '.kml'})
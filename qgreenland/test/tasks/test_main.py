@@ -0,0 +1,40 @@
+from unittest.mock import patch
+
+import luigi
+from luigi.task_register import Register
+
+from qgreenland.constants import CONFIG
+from qgreenland.tasks import main
+from qgreenland.tasks.main import CreateQgisProjectFile
+from qgreenland.util import fingerprint
+from qgreenland.util.luigi import LayerPipeline
+
+
+def test_project_file_rebuilt_when_layer_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(fingerprint, 'FINGERPRINTS_DIR',
+                        str(tmp_path / 'fingerprints'))
+    monkeypatch.setattr(main, 'generate_layer_tasks',
+                        lambda: [LayerPipeline(layer_id='coastlines')])
+    trigger_file = tmp_path / 'READY_TO_ZIP'
+    trigger_file.touch()
+
+    with patch.object(CreateQgisProjectFile, 'output',
+                      return_value=luigi.LocalTarget(str(trigger_file))):
+        task = CreateQgisProjectFile()
+        task.record_fingerprint()
+        assert task.complete()
+
+        monkeypatch.setitem(CONFIG['layers'], 'coastlines', {
+            **CONFIG['layers']['coastlines'],
+            'title': 'Changed title',
+        })
+        # Tasks are cached by parameters, along with their fingerprints.
+        Register.clear_instance_cache()
+
+        task = CreateQgisProjectFile()
+        assert not task.complete()
+
+        task.remove_stale_output()
+        assert not trigger_file.exists()
+
+    Register.clear_instance_cache()
@@ -0,0 +1,95 @@
+import os
+import shutil
+import stat
+from unittest.mock import patch
+
+import luigi
+import pytest
+
+from qgreenland.util import fingerprint
+from qgreenland.util import luigi as qgr_luigi
+from qgreenland.util.build_cache import (BuildCache,
+                                         LocalBuildCache,
+                                         get_build_cache)
+from qgreenland.util.luigi import LayerPipeline
+
+
+def _is_writable(fp):
+    # `os.access` ignores the mode when run as root.
+    return bool(os.stat(fp).st_mode & stat.S_IWUSR)
+
+
+def test_local_build_cache(tmp_path):
+    cache = LocalBuildCache(str(tmp_path / 'cache'))
+    layer_dir = tmp_path / 'layer'
+    layer_dir.mkdir()
+    (layer_dir / 'layer.tif').write_text('data')
+
+    assert not cache.contains('abc123')
+    assert not cache.restore('abc123', str(tmp_path / 'restored'))
+
+    cache.store('abc123', str(layer_dir))
+    assert cache.contains('abc123')
+    # Only the cache's copy is read-only.
+    assert _is_writable(layer_dir / 'layer.tif')
+
+    assert cache.restore('abc123', str(tmp_path / 'restored'))
+    assert (tmp_path / 'restored' / 'layer.tif').read_text() == 'data'
+    assert _is_writable(tmp_path / 'restored' / 'layer.tif')
+
+
+def test_local_build_cache_store_race(tmp_path):
+    cache = LocalBuildCache(str(tmp_path / 'cache'))
+    layer_dir = tmp_path / 'layer'
+    layer_dir.mkdir()
+    (layer_dir / 'layer.tif').write_text('ours')
+    copytree = shutil.copytree
+
+    def copytree_while_other_worker_stores(src, dst, **kwargs):
+        # Another worker's entry appears after the `contains` check.
+        entry_dir = tmp_path / 'cache' / 'ab' / 'abc123'
+        entry_dir.mkdir(parents=True)
+        (entry_dir / 'layer.tif').write_text('theirs')
+        return copytree(src, dst, **kwargs)
+
+    with patch('shutil.copytree', side_effect=copytree_while_other_worker_stores):
+        cache.store('abc123', str(layer_dir))
+
+    assert os.listdir(tmp_path / 'cache' / 'ab') == ['abc123']
+    assert (tmp_path / 'cache' / 'ab' / 'abc123' / 'layer.tif').read_text() == 'theirs'
+
+
+def test_build_cache_is_abstract():
+    with pytest.raises(TypeError):
+        BuildCache()
+
+
+def test_get_build_cache(tmp_path):
+    assert get_build_cache(None) is None
+    assert get_build_cache(str(tmp_path)).root == str(tmp_path)
+    assert get_build_cache(f'file://{tmp_path}').root == str(tmp_path)
+
+    with pytest.raises(RuntimeError):
+        get_build_cache('ftp://example.com/cache')
+
+
+def test_layer_pipeline_restores_from_build_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(fingerprint, 'FINGERPRINTS_DIR',
+                        str(tmp_path / 'fingerprints'))
+    cache = LocalBuildCache(str(tmp_path / 'cache'))
+    monkeypatch.setattr(qgr_luigi, 'get_build_cache', lambda: cache)
+
+    output_dir = tmp_path / 'final' / 'coastlines'
+    task = LayerPipeline(layer_id='coastlines')
+    with patch.object(LayerPipeline, 'output',
+                      return_value=luigi.LocalTarget(str(output_dir))):
+        assert not task.complete()
+
+        built_dir = tmp_path / 'built'
+        built_dir.mkdir()
+        (built_dir / 'coastlines.gpkg').write_text('data')
+        cache.store(task.fingerprint, str(built_dir))
+
+        assert task.complete()
+        assert os.path.isfile(output_dir / 'coastlines.gpkg')
+        assert task.recorded_fingerprint() == task.fingerprint
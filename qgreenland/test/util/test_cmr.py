@@ -0,0 +1,52 @@
+import hashlib
+from unittest.mock import MagicMock, patch
+
+from qgreenland.util import cmr
+
+
+def _mock_page(lines, search_after=None):
+    response = MagicMock()
+    response.ok = True
+    response.encoding = 'utf-8'
+    response.headers = {'CMR-Search-After': search_after} if search_after else {}
+    response.iter_lines.return_value = iter(lines)
+    response.__enter__.return_value = response
+
+    return response
+
+
+@patch.object(cmr, 'CMR_PAGE_SIZE', 2)
+@patch('qgreenland.util.cmr.requests.get')
+def test__search_granules_follows_search_after(mock_get):
+    mock_get.side_effect = [
+        _mock_page(['Granule UR,Start Time', 'a,1', '', 'b,2'], search_after='x'),
+        _mock_page(['Granule UR,Start Time', 'c,3'], search_after='y'),
+    ]
+
+    granules = list(cmr._search_granules('https://cmr.test'))
+
+    assert [g['Granule UR'] for g in granules] == ['a', 'b', 'c']
+    assert mock_get.call_count == 2
+    assert mock_get.call_args.kwargs['headers']['CMR-Search-After'] == 'x'
+
+
+@patch.object(cmr, '_search_granules')
+def test__cached_search_granules_falls_back_on_cmr_error(mock_search, tmp_path):
+    url = 'https://cmr.test'
+    cache_fp = tmp_path / f"{hashlib.sha256(url.encode('utf-8')).hexdigest()}.json"
+    # Stale, so CMR is queried.
+    cache_fp.write_text(
+        '{"fetched": "2000-01-01T00:00:00", "granules": [{"a": "1"}]}'
+    )
+
+    with patch.object(cmr, 'CMR_CACHE_DIR', str(tmp_path)):
+        mock_search.side_effect = cmr.CmrError('Error from CMR: 503')
+        assert cmr._cached_search_granules(url) == [{'a': '1'}]
+
+        cache_fp.unlink()
+        mock_search.side_effect = None
+        mock_search.return_value = iter([])
+        assert cmr._cached_search_granules(url) == []
+
+    # Empty results aren't cached.
+    assert not cache_fp.exists()
@@ -0,0 +1,32 @@
+import pytest
+
+from qgreenland.util.extent import transform_extent
+
+
+def test_transform_extent():
+    # Greenland, in polar stereographic north.
+    extent = {
+        'xmin': -998012.0, 'ymin': -3611178.0,
+        'xmax': 1228670.0, 'ymax': -329624.0,
+    }
+
+    xmin, ymin, xmax, ymax = transform_extent(
+        extent, from_crs='EPSG:3413', to_crs='EPSG:4326', margin=0,
+    )
+
+    # Greenland is about 60-83N, 73-11W; the extent's corners reach further.
+    assert xmin < -73 and xmax > -11
+    assert ymin < 60 and 83 < ymax < 90
+
+
+def test_transform_extent_around_pole():
+    extent = {
+        'xmin': -3850000.0, 'ymin': -5350000.0,
+        'xmax': 3750000.0, 'ymax': 5850000.0,
+    }
+
+    bounds = transform_extent(extent, from_crs='EPSG:3413', to_crs='EPSG:4326')
+
+    assert bounds[0] == -180 and bounds[2] == 180
+    assert bounds[3] == 90
+    assert bounds[1] == pytest.approx(30, abs=5)
@@ -0,0 +1,80 @@
+import inspect
+from unittest.mock import patch
+
+import luigi
+import pytest
+
+from qgreenland.util import fingerprint
+from qgreenland.util.fingerprint import FingerprintMixin, code_version
+
+
+class UpstreamTask(FingerprintMixin, luigi.Task):
+    output_path = luigi.Parameter()
+    value = luigi.IntParameter()
+
+    def output(self):
+        return luigi.LocalTarget(self.output_path)
+
+
+class DownstreamTask(FingerprintMixin, luigi.Task):
+    output_path = luigi.Parameter()
+    upstream_value = luigi.IntParameter()
+
+    def requires(self):
+        return UpstreamTask(output_path=f'{self.output_path}.upstream',
+                            value=self.upstream_value)
+
+    def output(self):
+        return luigi.LocalTarget(self.output_path)
+
+
+@pytest.fixture(autouse=True)
+def fingerprints_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(fingerprint, 'FINGERPRINTS_DIR',
+                        str(tmp_path / 'fingerprints'))
+
+
+def test_complete_requires_matching_fingerprint(tmp_path):
+    output_path = tmp_path / 'out.txt'
+    output_path.write_text('built')
+    task = UpstreamTask(output_path=str(output_path), value=1)
+
+    # Outputs built without a fingerprint are rebuilt.
+    assert not task.complete()
+
+    task.record_fingerprint()
+    assert task.complete()
+
+    changed = UpstreamTask(output_path=str(output_path), value=2)
+    assert changed.fingerprint != task.fingerprint
+    assert not changed.complete()
+
+    changed.remove_stale_output()
+    assert not output_path.exists()
+
+
+def test_fingerprint_includes_upstream(tmp_path):
+    output_path = str(tmp_path / 'out.txt')
+
+    assert (
+        DownstreamTask(output_path=output_path, upstream_value=1).fingerprint
+        != DownstreamTask(output_path=output_path, upstream_value=2).fingerprint
+    )
+
+
+def test_code_version_includes_imported_modules():
+    getsource = inspect.getsource
+
+    def edited_misc_source(module):
+        if module.__name__ == 'qgreenland.util.misc':
+            return 'edited'
+        return getsource(module)
+
+    original = code_version('qgreenland.util.luigi')
+    code_version.cache_clear()
+    try:
+        # `qgreenland.util.luigi` imports from `qgreenland.util.misc`.
+        with patch('inspect.getsource', side_effect=edited_misc_source):
+            assert code_version('qgreenland.util.luigi') != original
+    finally:
+        code_version.cache_clear()
@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+from qgreenland.util import input_cache
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    monkeypatch.setattr(input_cache, 'INPUT_CACHE_DIR', cache_dir)
+    monkeypatch.setattr(input_cache, 'MANIFEST_FP',
+                        os.path.join(cache_dir, 'manifest.json'))
+    monkeypatch.setattr(input_cache, 'STATS_FP',
+                        os.path.join(cache_dir, 'stats.json'))
+    monkeypatch.setattr(input_cache, 'LOCK_FP', os.path.join(cache_dir, '.lock'))
+
+    return cache_dir
+
+
+def _download(tmp_path, name, content):
+    fp = tmp_path / name
+    fp.write_bytes(content)
+
+    return str(fp)
+
+
+def test_store_deduplicates_identical_content(tmp_path, cache_dir):
+    entry_a = input_cache.store('http://a/f.txt',
+                                _download(tmp_path, 'a.part', b'data'),
+                                filename='f.txt',
+                                etag='"abc"')
+    entry_b = input_cache.store('http://b/f.txt',
+                                _download(tmp_path, 'b.part', b'data'),
+                                filename='f.txt')
+
+    assert input_cache.blob_path(entry_a) == input_cache.blob_path(entry_b)
+    assert input_cache.lookup('http://a/f.txt')['etag'] == '"abc"'
+    assert input_cache.lookup('http://c/f.txt') is None
+
+    stats = input_cache.log_stats()
+    assert stats['misses'] == 2
+    assert stats['bytes_deduplicated'] == 4
+
+
+def test_source_is_current(cache_dir):
+    # Sources fetched before the manifest existed are assumed current.
+    assert input_cache.source_is_current('dataset.source', 'sig')
+
+    input_cache.record_source('dataset.source', 'sig')
+
+    assert input_cache.source_is_current('dataset.source', 'sig')
+    assert not input_cache.source_is_current('dataset.source', 'new_sig')
+
+
+def test_prune(tmp_path, cache_dir):
+    kept = input_cache.store('http://a/kept.txt',
+                             _download(tmp_path, 'a.part', b'kept'),
+                             filename='kept.txt')
+    removed = input_cache.store('http://b/removed.txt',
+                                _download(tmp_path, 'b.part', b'removed'),
+                                filename='removed.txt')
+    input_cache.record_source('a.only', 'sig', urls=['http://a/kept.txt'])
+    input_cache.record_source('b.only', 'sig', urls=['http://b/removed.txt'])
+
+    assert input_cache.prune(source_keys={'a.only'}) == len(b'removed')
+
+    assert os.path.isfile(input_cache.blob_path(kept))
+    assert not os.path.exists(input_cache.blob_path(removed))
+    assert input_cache.lookup('http://a/kept.txt') is not None
+    assert input_cache.lookup('http://b/removed.txt') is None
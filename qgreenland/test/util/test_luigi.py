@@ -0,0 +1,84 @@
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import luigi
+
+from qgreenland.constants import CONFIG, TaskType
+from qgreenland.util.luigi import (
+    LayerTask,
+    count_task_references,
+    cpus_per_worker
+)
+from qgreenland.util.misc import get_layer_dir
+
+
+class FinalLayerTask(LayerTask):
+    task_type = TaskType.FINAL
+
+
+class HeavyLayerTask(LayerTask):
+    task_type = TaskType.WIP
+    default_resources = {'memory_gb': 2}
+    default_priority = 10
+
+
+@patch('os.makedirs')
+def test_outdir_final_matches_layer_dir(mock_makedirs):
+    task = FinalLayerTask(requires_task=None, layer_id='coastlines')
+
+    assert task.outdir == get_layer_dir(task.layer_cfg)
+    # Computing the path must not create directories.
+    mock_makedirs.assert_not_called()
+
+
+def test_layer_task_resources(monkeypatch):
+    layer_cfg = {'id': 'big_raster', 'resources': {'memory_gb': 5}}
+    monkeypatch.setitem(CONFIG['layers'], 'big_raster', layer_cfg)
+
+    heavy = HeavyLayerTask(requires_task=None, layer_id='big_raster')
+    assert heavy.resources == {'memory_gb': 5}
+    assert heavy.priority == 10
+
+    # Tasks which declare no resources aren't limited by layer estimates.
+    light = FinalLayerTask(requires_task=None, layer_id='big_raster')
+    assert light.resources == {}
+    assert light.priority == 0
+
+
+def test_find_input_file_prefers_layer_file(tmp_path):
+    task = FinalLayerTask(requires_task=None, layer_id='coastlines')
+    (tmp_path / 'coastlines.vrt').touch()
+    (tmp_path / 'other_layer.vrt').touch()
+
+    with patch.object(FinalLayerTask, 'input',
+                      return_value=luigi.LocalTarget(str(tmp_path))):
+        assert task.find_input_file(ext='.vrt') == str(tmp_path / 'coastlines.vrt')
+
+
+class SharedTask(luigi.Task):
+    source = luigi.Parameter()
+
+
+class PipelineTask(luigi.Task):
+    layer = luigi.Parameter()
+
+    def requires(self):
+        return SharedTask(source='shared')
+
+
+def test_count_task_references():
+    references, unique = count_task_references(
+        [PipelineTask(layer='a'), PipelineTask(layer='b')]
+    )
+
+    assert references == {'PipelineTask': 2, 'SharedTask': 2}
+    assert unique == {'PipelineTask': 2, 'SharedTask': 1}
+
+
+@patch('os.cpu_count', return_value=16)
+def test_cpus_per_worker(_mock_cpu_count):
+    with patch('luigi.interface.core', return_value=SimpleNamespace(workers=4)):
+        assert cpus_per_worker() == 4
+
+    with patch('luigi.interface.core', return_value=SimpleNamespace(workers=32)):
+        assert cpus_per_worker() == 1
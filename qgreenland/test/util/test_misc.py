@@ -1,10 +1,14 @@
+import gzip
+import json
 import os
-from unittest.mock import patch
+import zipfile
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
 
 import pytest
 
 from qgreenland.constants import TaskType
-from qgreenland.util import misc
+from qgreenland.util import fingerprint, misc
 
 
 @patch('os.path.isfile')
@@ -72,3 +76,142 @@ def test_layer_path_remote_multiple_urls():
 
     with pytest.raises(RuntimeError):
         misc.get_layer_path(mock_layer_cfg)
+
+
+def test__write_chunks(tmp_path):
+    fp = tmp_path / 'out.bin'
+    chunks = [b'abc', b'', b'defg']
+
+    num_bytes = misc._write_chunks(iter(chunks), fp)
+
+    assert num_bytes == 7
+    assert fp.read_bytes() == b'abcdefg'
+
+
+def test__resume_headers():
+    state = {'accept_ranges': True, 'etag': '"abc"', 'last_modified': 'Mon'}
+
+    assert misc._resume_headers(state, 0) == {}
+    assert misc._resume_headers(state, 10) == {
+        'Range': 'bytes=10-',
+        'If-Range': '"abc"',
+    }
+
+    # Weak ETags can't be used with `If-Range`.
+    weak_state = {**state, 'etag': 'W/"abc"'}
+    assert misc._resume_headers(weak_state, 10)['If-Range'] == 'Mon'
+
+    assert misc._resume_headers({**state, 'accept_ranges': False}, 10) == {}
+
+
+class _ChunkedResponse:
+    """A `200` response with no `Content-Length`, like a chunked response."""
+
+    status_code = 200
+    headers = {}
+
+    def __init__(self, content):
+        self.content = content
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield self.content
+
+
+def test__fetch_to_staging_after_cached(tmp_path):
+    url = 'https://example.com/data.zip'
+    part_fp, state_fp = misc._staged_download_paths(url, str(tmp_path))
+    # A completed download of unknown length which has since been moved in to
+    # the input cache.
+    misc._write_download_state(state_fp, {'filename': 'data.zip',
+                                          'complete': True})
+
+    session = MagicMock()
+    session.get.return_value = _ChunkedResponse(b'data')
+    staged_fp, state = misc._fetch_to_staging(url,
+                                              staging_dir=str(tmp_path),
+                                              session=session,
+                                              chunk_size=1024)
+
+    session.get.assert_called_once()
+    assert staged_fp == part_fp
+    assert state['complete']
+    with open(staged_fp, 'rb') as f:
+        assert f.read() == b'data'
+
+
+def test_extract_members(tmp_path):
+    zip_fp = tmp_path / 'archive.zip'
+    with zipfile.ZipFile(zip_fp, 'w') as zf:
+        zf.writestr('data/layer.shp', b'shp')
+        zf.writestr('data/layer.dbf', b'dbf')
+        zf.writestr('README.txt', b'readme')
+
+    extracted = misc.extract_members(
+        zip_fp, tmp_path / 'out',
+        open_archive=zipfile.ZipFile,
+        select=lambda name: name.startswith('data/'),
+        max_workers=2,
+    )
+
+    assert sorted(extracted) == ['data/layer.dbf', 'data/layer.shp']
+    assert (tmp_path / 'out' / 'data' / 'layer.shp').read_bytes() == b'shp'
+    assert not (tmp_path / 'out' / 'README.txt').exists()
+
+    # Nothing selected; extract everything.
+    extracted = misc.extract_members(zip_fp, tmp_path / 'all',
+                                     open_archive=zipfile.ZipFile,
+                                     select=lambda name: False)
+    assert len(extracted) == 3
+
+
+def test_extract_members_outside_archive(tmp_path):
+    zip_fp = tmp_path / 'archive.zip'
+    with zipfile.ZipFile(zip_fp, 'w') as zf:
+        zf.writestr('../evil.txt', b'evil')
+
+    with pytest.raises(RuntimeError):
+        misc.extract_members(zip_fp, tmp_path / 'out',
+                             open_archive=zipfile.ZipFile)
+
+
+def test_gunzip_file(tmp_path):
+    data = os.urandom(3000)
+    with gzip.open(tmp_path / 'part.gz', 'wb') as f:
+        f.write(data)
+
+    misc.gunzip_file(tmp_path / 'part.gz', tmp_path / 'part', chunk_size=1024)
+
+    assert (tmp_path / 'part').read_bytes() == data
+
+
+def test_prune_final_dir(tmp_path, monkeypatch):
+    final_dir = tmp_path / 'final'
+    fingerprints_dir = tmp_path / 'fingerprints'
+    fingerprints_dir.mkdir()
+    monkeypatch.setattr(misc, 'TaskType',
+                        SimpleNamespace(FINAL=SimpleNamespace(value=str(final_dir))))
+    monkeypatch.setattr(fingerprint, 'FINGERPRINTS_DIR', str(fingerprints_dir))
+
+    kept = final_dir / 'group' / 'kept'
+    removed = final_dir / 'group' / 'removed'
+    by_hand = final_dir / 'by_hand'
+    for layer_dir in (kept, removed, by_hand):
+        layer_dir.mkdir(parents=True)
+    for name, layer_dir in (('kept', kept), ('removed', removed)):
+        (fingerprints_dir / name).write_text(
+            json.dumps({'fingerprint': name, 'outputs': [str(layer_dir)]}),
+        )
+
+    misc.prune_final_dir(layer_dirs=[str(kept)])
+
+    assert kept.is_dir()
+    assert not removed.exists()
+    assert not (fingerprints_dir / 'removed').exists()
+    # Not created by the pipeline.
+    assert by_hand.is_dir()
@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+
+import pytest
+
+from qgreenland.util.raster import (
+    COG_DEFAULTS,
+    _cog_creation_options,
+    _source_window
+)
+
+
+def _dataset(geotransform, width, height):
+    return SimpleNamespace(
+        GetGeoTransform=lambda: geotransform,
+        RasterXSize=width,
+        RasterYSize=height,
+    )
+
+
+def test_source_window():
+    # Global 1 degree grid.
+    ds = _dataset((-180, 1, 0, 90, 0, -1), 360, 180)
+
+    assert _source_window(
+        ds, (-80.5, 55.2, 10.1, 90), geographic=True,
+    ) == [99, 0, 92, 35]
+
+
+def test_source_window_whole_raster():
+    ds = _dataset((-180, 1, 0, 90, 0, -1), 360, 180)
+
+    assert _source_window(ds, (-200, -100, 200, 100), geographic=True) is None
+
+
+def test_source_window_0_to_360():
+    ds = _dataset((0, 1, 0, 90, 0, -1), 360, 180)
+
+    assert _source_window(ds, (-80, 55, 10, 90), geographic=True) is None
+
+
+def test_cog_creation_options_layer_options():
+    options = _cog_creation_options(
+        {**COG_DEFAULTS, 'predictor': 2},
+        cog_driver=True,
+        creation_options=['BIGTIFF=YES', 'compress=DEFLATE'],
+    )
+
+    assert 'BIGTIFF=YES' in options
+    assert 'COMPRESS=DEFLATE' in options
+    assert 'PREDICTOR=2' in options
+
+
+def test_cog_creation_options_conflict():
+    with pytest.raises(RuntimeError, match='COMPRESS'):
+        _cog_creation_options(COG_DEFAULTS,
+                              cog_driver=False,
+                              creation_options=['COMPRESS=LZW'])
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+import rasterio as rio
+from rasterio.transform import from_origin
+
+from qgreenland.util.raster_calc import calc_raster
+
+
+def _write_raster(fp, data, *, nodata=None):
+    with rio.open(
+        fp, 'w',
+        driver='GTiff',
+        width=data.shape[1],
+        height=data.shape[0],
+        count=1,
+        dtype=data.dtype,
+        crs='EPSG:3413',
+        transform=from_origin(-3850000, 5850000, 25000, 25000),
+        nodata=nodata,
+        tiled=True,
+        blockxsize=16,
+        blockysize=16,
+    ) as ds:
+        ds.write(data, 1)
+
+
+def test_calc_raster(tmp_path):
+    a = np.arange(64 * 48, dtype='uint16').reshape(64, 48)
+    a[0, 0] = 9999
+    _write_raster(tmp_path / 'a.tif', a, nodata=9999)
+
+    out_fp = tmp_path / 'out.tif'
+    calc_raster({'A': tmp_path / 'a.tif'}, out_fp,
+                calc='A / 10.0', max_workers=3)
+
+    with rio.open(out_fp) as ds:
+        # Like gdal_calc.py, the output type defaults to the input type.
+        assert ds.dtypes[0] == 'uint16'
+        assert ds.nodata == 65535
+        result = ds.read(1)
+
+    assert result[0, 0] == 65535
+    np.testing.assert_array_equal(result[1:], (a[1:] / 10.0).astype('uint16'))
+
+
+def test_calc_raster_multiple_inputs(tmp_path):
+    a = np.full((32, 32), 2, dtype='uint8')
+    b = np.full((32, 32), 0.5, dtype='float32')
+    b[5, 5] = -1
+    _write_raster(tmp_path / 'a.tif', a)
+    _write_raster(tmp_path / 'b.tif', b, nodata=-1)
+
+    out_fp = tmp_path / 'out.tif'
+    calc_raster({'A': tmp_path / 'a.tif', 'B': tmp_path / 'b.tif'}, out_fp,
+                calc='where(A > 1, A * B, 0)',
+                output_type='Float64',
+                nodata=-9)
+
+    with rio.open(out_fp) as ds:
+        assert ds.dtypes[0] == 'float64'
+        result = ds.read(1)
+
+    assert result[5, 5] == -9
+    assert result[0, 0] == 1.0
+
+
+@pytest.mark.parametrize('a_dtype,b_dtype,expected', [
+    ('uint8', 'int16', 'int16'),
+    # numpy would promote these to int32.
+    ('uint16', 'int16', 'int16'),
+])
+def test_calc_raster_mixed_input_types(tmp_path, a_dtype, b_dtype, expected):
+    _write_raster(tmp_path / 'a.tif', np.full((32, 32), 2, dtype=a_dtype))
+    _write_raster(tmp_path / 'b.tif', np.full((32, 32), -3, dtype=b_dtype))
+
+    out_fp = tmp_path / 'out.tif'
+    calc_raster({'A': tmp_path / 'a.tif', 'B': tmp_path / 'b.tif'}, out_fp,
+                calc='A + B')
+
+    with rio.open(out_fp) as ds:
+        # Like gdal_calc.py, the largest input type in GDAL's type order.
+        assert ds.dtypes[0] == expected
+        assert ds.read(1)[0, 0] == -1
+
+
+def test_calc_raster_invalid_expression(tmp_path):
+    with pytest.raises(RuntimeError):
+        calc_raster({}, tmp_path / 'out.tif', calc='A /')
+
+
+def test_calc_raster_byte_nodata(tmp_path):
+    a = np.zeros((32, 32), dtype='uint8')
+    a[0, 0] = 1
+    _write_raster(tmp_path / 'a.tif', a, nodata=1)
+
+    out_fp = tmp_path / 'out.tif'
+    calc_raster({'A': tmp_path / 'a.tif'}, out_fp, calc='A', output_type='Byte')
+
+    with rio.open(out_fp) as ds:
+        # Like gdal_calc.py; zero is a valid value, e.g. in masks.
+        assert ds.nodata == 255
+        result = ds.read(1)
+
+    assert result[0, 0] == 255
+    assert result[1, 1] == 0
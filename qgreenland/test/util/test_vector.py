@@ -0,0 +1,29 @@
+from qgreenland.util.vector import filter_args, ogr2ogr_args
+
+
+def test_ogr2ogr_args():
+    args = ogr2ogr_args(
+        makevalid='',
+        t_srs='EPSG:3413',
+        clipdst='"-1" "-2" "3" "4"',
+        sql="'SELECT *, Name as label from \"Ice Core\"'",
+    )
+
+    assert args == [
+        '-makevalid',
+        '-t_srs', 'EPSG:3413',
+        '-clipdst', '-1', '-2', '3', '4',
+        '-sql', 'SELECT *, Name as label from "Ice Core"',
+    ]
+
+
+def test_filter_args():
+    args = filter_args(where='ZONE != 0', bbox=[-180, 40, 180, 90.0],
+                       select=['ZONE', 'NAME'])
+
+    assert args == [
+        '-where', 'ZONE != 0',
+        '-spat', '-180', '40', '180', '90.0',
+        '-select', 'ZONE,NAME',
+    ]
+    assert filter_args() == []
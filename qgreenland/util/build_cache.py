@@ -0,0 +1,121 @@
+"""Cache of built layer directories, keyed by fingerprint.
+
+Layers built on one machine (e.g. production) can be restored on another
+instead of being rebuilt, as long as they were built from the same config and
+code. See `qgreenland.util.fingerprint`.
+
+The backend is chosen by the scheme of `BUILD_CACHE`. A plain path (or a
+`file://` URL) is a directory, which may be on a network share.
+"""
+
+import abc
+import logging
+import os
+import shutil
+import urllib.parse
+
+import luigi
+from luigi.target import FileAlreadyExists
+
+from qgreenland.constants import BUILD_CACHE
+from qgreenland.util.misc import temporary_path_dir
+
+logger = logging.getLogger('luigi-interface')
+
+
+class BuildCache(abc.ABC):
+    """Interface for build cache backends."""
+
+    @abc.abstractmethod
+    def contains(self, key):
+        """Check whether a directory is stored under `key`."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def restore(self, key, output_dir):
+        """Restore the directory stored under `key` to `output_dir`.
+
+        Returns False if nothing is stored under `key`. `output_dir` must not
+        exist, and is only created once completely restored.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def store(self, key, input_dir):
+        """Store a copy of `input_dir` under `key`.
+
+        If another build stores the same key first, its entry is kept.
+        """
+        raise NotImplementedError
+
+
+class LocalBuildCache(BuildCache):
+    """Store entries as directories under `root`.
+
+    Files are copied to and from the cache rather than hard linked. Cached
+    files are made read-only, and only the cache's copies are; restored
+    files (and so the release zip) get normal permissions.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def contains(self, key):
+        return os.path.isdir(self._entry_dir(key))
+
+    def restore(self, key, output_dir):
+        if not self.contains(key):
+            return False
+
+        with temporary_path_dir(luigi.LocalTarget(output_dir)) as temp_path:
+            # Copy contents only, not the read-only mode.
+            shutil.copytree(self._entry_dir(key), temp_path,
+                            copy_function=shutil.copyfile,
+                            dirs_exist_ok=True)
+
+        return True
+
+    def store(self, key, input_dir):
+        if self.contains(key):
+            return
+
+        # Entries are only complete once renamed in to place.
+        entry_target = luigi.LocalTarget(self._entry_dir(key))
+        try:
+            with temporary_path_dir(entry_target) as temp_path:
+                shutil.copytree(input_dir, temp_path, dirs_exist_ok=True)
+                for dirpath, _, filenames in os.walk(temp_path):
+                    for filename in filenames:
+                        os.chmod(os.path.join(dirpath, filename), 0o444)
+        except (FileAlreadyExists, OSError):
+            if not self.contains(key):
+                raise
+
+            # Another worker built the same layer and stored it first.
+            logger.info(f'Build cache entry {key} already stored.')
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+
+# Build cache backends, by URL scheme.
+BACKENDS = {
+    '': LocalBuildCache,
+    'file': LocalBuildCache,
+}
+
+
+def get_build_cache(location=BUILD_CACHE):
+    """Return the build cache at `location`, or None if it's not set."""
+    if not location:
+        return None
+
+    url = urllib.parse.urlparse(location)
+    if url.scheme not in BACKENDS:
+        raise RuntimeError(
+            f"Unsupported build cache '{location}'."
+            f' Must be a path or a URL with scheme: {[s for s in BACKENDS if s]}'
+        )
+
+    return BACKENDS[url.scheme](url.path)
@@ -1,34 +1,128 @@
 import csv
 import datetime
+import hashlib
+import json
+import logging
+import os
 import pprint
 from collections import namedtuple
 
 import requests
 
-from qgreenland.constants import REQUEST_TIMEOUT
+from qgreenland.constants import CMR_CACHE_DIR, REQUEST_TIMEOUT
+
+logger = logging.getLogger('luigi-interface')
 
 CMR_CLIENT_ID_HEADER = {'Client-Id': 'nsidc-qgreenland'}
 CMR_BASE_URL = 'https://cmr.earthdata.nasa.gov'
 CMR_GRANULES_URL = f'{CMR_BASE_URL}/search/granules.csv'
+CMR_PAGE_SIZE = 2000
 
-CMR_GRANULES_SCROLL_URL = (
+CMR_GRANULES_SEARCH_URL = (
     CMR_GRANULES_URL
-    + '?scroll=true&page_size=2000&'
+    + f'?page_size={CMR_PAGE_SIZE}&'
     + 'sort_key[]=%2Bstart_date&online_only=true'
 )
 
+# Cached granule lookups are used without asking CMR for this long. Older
+# cached lookups are still used if CMR can't be reached.
+CMR_CACHE_TTL = datetime.timedelta(days=7)
+
 Granule = namedtuple('Granule', ['urls', 'start_time'])
 
 
+class CmrError(RuntimeError):
+    """CMR responded with an error."""
+
+
 def _clean_granules_csv(granules):
     """Filter out blank lines."""
-    return [g for g in granules if g]
+    return (g for g in granules if g)
+
+
+def _search_granules(url):
+    """Yield each granule matching the query `url` as a dict.
+
+    Follows CMR's `CMR-Search-After` header to get every page of results.
+    Each page's CSV is parsed as it's streamed, so memory use doesn't depend
+    on the number of results.
+    """
+    headers = dict(CMR_CLIENT_ID_HEADER)
+
+    while True:
+        with requests.get(url,
+                          headers=headers,
+                          timeout=REQUEST_TIMEOUT,
+                          stream=True) as response:
+            if not response.ok:
+                raise CmrError(f'Error from CMR: {response.text}')
+
+            response.encoding = response.encoding or 'utf-8'
+            lines = response.iter_lines(decode_unicode=True)
+
+            page_count = 0
+            for granule in csv.DictReader(_clean_granules_csv(lines)):
+                page_count += 1
+                yield granule
 
+            search_after = response.headers.get('CMR-Search-After')
 
-def _csv_granules_to_dicts(resp_text):
-    granules_csv = _clean_granules_csv(resp_text.split('\n'))
+        if not search_after or page_count < CMR_PAGE_SIZE:
+            return
 
-    return list(csv.DictReader(granules_csv))
+        headers['CMR-Search-After'] = search_after
+
+
+def _read_cached_search(cache_fp):
+    try:
+        with open(cache_fp) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_cached_search(cache_fp, granules):
+    os.makedirs(CMR_CACHE_DIR, exist_ok=True)
+    tmp_fp = f'{cache_fp}.tmp'
+    with open(tmp_fp, 'w') as f:
+        json.dump({
+            'fetched': datetime.datetime.utcnow().isoformat(),
+            'granules': granules,
+        }, f)
+    os.replace(tmp_fp, cache_fp)
+
+
+def _cached_search_granules(url):
+    """Return all granules matching the query `url`, cached on disk.
+
+    Cached results younger than `CMR_CACHE_TTL` are used without a request.
+    If CMR can't be reached or responds with an error, cached results of any
+    age are used so that builds can run offline. Empty results aren't cached,
+    since they're usually a temporary problem with CMR.
+    """
+    cache_key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    cache_fp = os.path.join(CMR_CACHE_DIR, f'{cache_key}.json')
+    cached = _read_cached_search(cache_fp)
+
+    if cached:
+        fetched = datetime.datetime.fromisoformat(cached['fetched'])
+        if datetime.datetime.utcnow() - fetched < CMR_CACHE_TTL:
+            return cached['granules']
+
+    try:
+        granules = list(_search_granules(url))
+    except (requests.RequestException, CmrError) as e:
+        if not cached:
+            raise
+
+        logger.warning(f'Failed to query CMR ({e}). Using cached results from'
+                       f" {cached['fetched']} instead.")
+        return cached['granules']
+
+    if granules:
+        _write_cached_search(cache_fp, granules)
+
+    return granules
 
 
 def get_cmr_granule(*, granule_ur, collection_concept_id):
@@ -55,17 +149,14 @@ def get_cmr_granule(*, granule_ur, collection_concept_id):
 
         return Granule(urls=tuple(url.split(',')), start_time=start_time)
 
-    url = (f'{CMR_GRANULES_SCROLL_URL}'
+    url = (f'{CMR_GRANULES_SEARCH_URL}'
            f'&collection_concept_id[]={collection_concept_id}'
            f'&granule_ur[]={granule_ur}')
-    response = requests.get(url,
-                            headers=CMR_CLIENT_ID_HEADER,
-                            timeout=REQUEST_TIMEOUT)
 
-    if not response.ok:
-        raise RuntimeError(f'Error from CMR: {response.text}')
+    granules = _cached_search_granules(url)
 
-    granules = _csv_granules_to_dicts(response.text)
+    if not granules:
+        raise RuntimeError(f'No granule found with Granule UR {granule_ur}')
 
     if len(granules) > 1:
         raise RuntimeError('Expecting only one granule')
@@ -74,7 +165,7 @@ def get_cmr_granule(*, granule_ur, collection_concept_id):
 
 
 def search_cmr_granules(*, short_name, version):
-    """Only supports one page of results, limited to 2000 granules."""
+    """Yield every granule in a collection, as a dict, one page at a time."""
 
     def _version_query_string(version):
         max_pad_length = 3
@@ -82,22 +173,16 @@ def search_cmr_granules(*, short_name, version):
         versions = [version.zfill(n + 1) for n in range(versions_needed)]
         return ''.join([f'&version={v}' for v in versions])
 
-    url = (f'{CMR_GRANULES_SCROLL_URL}'
+    url = (f'{CMR_GRANULES_SEARCH_URL}'
            f'&short_name={short_name}'
            f'{_version_query_string(version)}')
 
-    response = requests.get(url,
-                            headers=CMR_CLIENT_ID_HEADER,
-                            timeout=REQUEST_TIMEOUT)
-
-    if not response.ok:
-        raise RuntimeError(f'Error from CMR: {response.text}')
-
-    return _csv_granules_to_dicts(response.text)
+    yield from _search_granules(url)
 
 
 def pretty_search_cmr_granules(**kwargs):
     try:
-        pprint.pprint(search_cmr_granules(**kwargs))
+        for granule in search_cmr_granules(**kwargs):
+            pprint.pprint(granule)
     except BrokenPipeError:
         pass
@@ -1,8 +1,23 @@
 import os
+import threading
+import urllib.parse
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from qgreenland.constants import URS_COOKIE
+from qgreenland.constants import MAX_CONNECTIONS_PER_HOST, URS_COOKIE
+
+URS_HOST = 'urs.earthdata.nasa.gov'
+
+# Authenticated sessions shared by all fetches in this process, keyed by host.
+_sessions = {}
+_sessions_pid = None
+_session_locks = {}
+_sessions_lock = threading.Lock()
+
+# Earthdata Login cookies, copied in to each new session so that only the
+# first host needs to send credentials.
+_urs_cookies = requests.cookies.RequestsCookieJar()
 
 
 def create_earthdata_authenticated_session(s=None, *, hosts):
@@ -24,7 +39,7 @@ def create_earthdata_authenticated_session(s=None, *, hosts):
 
         redirected = resp.status_code == 302
         redirected_to_urs = \
-            redirected and 'urs.earthdata.nasa.gov' in headers['location']
+            redirected and URS_HOST in headers['location']
 
         if not (redirected_to_urs):
             print(f'Host {host} did not redirect to URS -- continuing without auth.')
@@ -44,6 +59,69 @@ def create_earthdata_authenticated_session(s=None, *, hosts):
     return s
 
 
+def _make_pooled_session():
+    """Create a session which keeps connections alive for reuse.
+
+    The pool is sized to match the number of simultaneous downloads allowed
+    per host.
+    """
+    s = requests.session()
+    adapter = HTTPAdapter(pool_connections=MAX_CONNECTIONS_PER_HOST,
+                          pool_maxsize=MAX_CONNECTIONS_PER_HOST)
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+
+    return s
+
+
+def _host_lock(host):
+    """Get the lock guarding creation of `host`'s session.
+
+    Must be called with `_sessions_lock` held.
+    """
+    global _sessions_pid
+
+    # Connections must not be shared with a parent process, e.g. when luigi
+    # forks a process for each task when running with multiple workers.
+    if _sessions_pid != os.getpid():
+        _sessions.clear()
+        _session_locks.clear()
+        _sessions_pid = os.getpid()
+
+    return _session_locks.setdefault(host, threading.Lock())
+
+
+def get_earthdata_authenticated_session(url):
+    """Get a session, authenticated with Earthdata Login if needed, for `url`.
+
+    Sessions are shared by every caller in the process, so the authentication
+    handshake happens once per host instead of once per file. Safe to call
+    from multiple threads.
+    """
+    parsed = urllib.parse.urlparse(url)
+    host = f'{parsed.scheme}://{parsed.netloc}'
+
+    with _sessions_lock:
+        lock = _host_lock(host)
+
+    # Authenticate with different hosts in parallel, but only once per host.
+    with lock:
+        if host not in _sessions:
+            s = _make_pooled_session()
+            with _sessions_lock:
+                s.cookies.update(_urs_cookies)
+
+            create_earthdata_authenticated_session(s, hosts=[url])
+
+            with _sessions_lock:
+                for cookie in s.cookies:
+                    if cookie.domain.lstrip('.') == URS_HOST:
+                        _urs_cookies.set_cookie(cookie)
+                _sessions[host] = s
+
+        return _sessions[host]
+
+
 def _get_earthdata_creds():
     if not os.environ['EARTHDATA_USERNAME']:
         raise RuntimeError('Environment variable EARTHDATA_USERNAME must be defined.')
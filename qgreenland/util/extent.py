@@ -0,0 +1,89 @@
+"""Transform the project's extents in to the CRS of source data.
+
+Used to filter or crop sources to the area we need before reprojecting them.
+"""
+
+import math
+
+import pyproj
+
+# Number of points each edge of an extent is split in to before transforming,
+# so curved edges in the target CRS are followed closely.
+DENSIFY_POINTS = 100
+# Fraction of the width/height added to each side of a transformed extent.
+MARGIN = 0.05
+
+
+def _densified_boundary(extent, *, densify_points):
+    xmin, ymin = extent['xmin'], extent['ymin']
+    xmax, ymax = extent['xmax'], extent['ymax']
+    steps = [i / densify_points for i in range(densify_points + 1)]
+
+    xs = [xmin + (xmax - xmin) * s for s in steps]
+    ys = [ymin + (ymax - ymin) * s for s in steps]
+
+    return (
+        [(x, ymin) for x in xs] + [(x, ymax) for x in xs]
+        + [(xmin, y) for y in ys] + [(xmax, y) for y in ys]
+    )
+
+
+def _poles_within(extent, *, crs):
+    """Return the points, in `crs`, of the poles within `extent`."""
+    from_lon_lat = pyproj.Transformer.from_crs('EPSG:4326', crs, always_xy=True)
+
+    poles = []
+    for pole_lat in (90, -90):
+        x, y = from_lon_lat.transform(0, pole_lat)
+        if (math.isfinite(x) and math.isfinite(y)
+                and extent['xmin'] <= x <= extent['xmax']
+                and extent['ymin'] <= y <= extent['ymax']):
+            poles.append((x, y))
+
+    return poles
+
+
+def transform_extent(extent, *, from_crs, to_crs,
+                     densify_points=DENSIFY_POINTS, margin=MARGIN):
+    """Return `(xmin, ymin, xmax, ymax)` in `to_crs` covering `extent`.
+
+    `extent` is a dict with keys `xmin`, `ymin`, `xmax`, `ymax` in `from_crs`,
+    like the extents in `project.yml`. The edges of the extent are densified
+    before transforming. If the extent contains a pole and `to_crs` is
+    geographic, the result spans all longitudes up to that pole. A margin is
+    added to the result to allow for error.
+
+    Returns None if the extent can't be transformed to `to_crs`.
+    """
+    to_crs = pyproj.CRS.from_user_input(to_crs)
+    transformer = pyproj.Transformer.from_crs(from_crs, to_crs, always_xy=True)
+
+    # The boundary of an extent around a pole doesn't reach the pole.
+    poles = _poles_within(extent, crs=from_crs)
+    points = [
+        transformer.transform(x, y)
+        for x, y in _densified_boundary(extent, densify_points=densify_points)
+        + poles
+    ]
+    points = [
+        (x, y) for x, y in points if math.isfinite(x) and math.isfinite(y)
+    ]
+    if not points:
+        return None
+
+    xs, ys = zip(*points)
+    xmin, ymin, xmax, ymax = min(xs), min(ys), max(xs), max(ys)
+
+    width, height = xmax - xmin, ymax - ymin
+    xmin, xmax = xmin - width * margin, xmax + width * margin
+    ymin, ymax = ymin - height * margin, ymax + height * margin
+
+    if to_crs.is_geographic:
+        if poles:
+            # Every longitude meets at the pole.
+            xmin, xmax = -180, 180
+
+        xmin, xmax = max(xmin, -180), min(xmax, 180)
+        ymin, ymax = max(ymin, -90), min(ymax, 90)
+
+    return xmin, ymin, xmax, ymax
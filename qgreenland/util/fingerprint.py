@@ -0,0 +1,201 @@
+"""Rebuild task outputs when the config or code they were built with changes.
+
+Luigi considers a task complete when its output exists. Tasks using
+`FingerprintMixin` are only complete when their output was also built with
+the current fingerprint: a hash of the task's effective config, the
+fingerprints of the tasks it requires, and the source of the code it runs.
+
+The fingerprint is recorded in `FINGERPRINTS_DIR` when a task succeeds,
+along with the paths of the outputs it stamps. A stale output is removed when
+its task starts, so it's rebuilt from scratch.
+"""
+
+import hashlib
+import importlib
+import inspect
+import json
+import logging
+import os
+import shutil
+from functools import cached_property, lru_cache
+
+import luigi
+
+from qgreenland.constants import FINGERPRINTS_DIR
+
+logger = logging.getLogger('luigi-interface')
+
+
+def _hash(obj):
+    obj_str = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.sha256(obj_str.encode('utf-8')).hexdigest()
+
+
+def file_fingerprint(fp):
+    """Hash the contents of a small file, e.g. one copied in to the package."""
+    with open(fp, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _imported_modules(module):
+    """Return the names of the `qgreenland` modules `module` imports from."""
+    names = set()
+    for value in vars(module).values():
+        value_module = inspect.getmodule(value)
+        if value_module and value_module.__name__.startswith('qgreenland.'):
+            names.add(value_module.__name__)
+
+    return names
+
+
+@lru_cache(maxsize=None)
+def code_version(module_name):
+    """Hash the source of `module_name` and every `qgreenland` module it uses.
+
+    Changes to the code a task runs, directly or through the utilities it
+    imports, change its fingerprint.
+
+    Only names bound at module scope are followed, so modules imported inside
+    a function, and data files read by the code (e.g. templates), aren't
+    covered. Config files are covered by each task's `fingerprint_config`
+    instead.
+    """
+    sources = {}
+    to_visit = [module_name]
+    while to_visit:
+        name = to_visit.pop()
+        if name in sources:
+            continue
+
+        module = importlib.import_module(name)
+        sources[name] = inspect.getsource(module)
+        to_visit.extend(_imported_modules(module))
+
+    return _hash(sources)
+
+
+def _read_stamp(stamp_path):
+    try:
+        with open(stamp_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        # Stamps from before outputs were recorded; rebuild.
+        return None
+
+
+def recorded_outputs():
+    """Map the output paths of fingerprinted tasks to their stamp files."""
+    if not os.path.isdir(FINGERPRINTS_DIR):
+        return {}
+
+    outputs = {}
+    for name in os.listdir(FINGERPRINTS_DIR):
+        stamp_path = os.path.join(FINGERPRINTS_DIR, name)
+        stamp = _read_stamp(stamp_path)
+        if stamp is None:
+            continue
+
+        for output_path in stamp['outputs']:
+            outputs[os.path.normpath(output_path)] = stamp_path
+
+    return outputs
+
+
+def task_fingerprint(task):
+    """Return the fingerprint of any task.
+
+    Tasks without `FingerprintMixin` (e.g. fetches, whose inputs are cached by
+    content) are identified by their task ID and the tasks they require.
+    """
+    if isinstance(task, FingerprintMixin):
+        return task.fingerprint
+
+    return _hash({
+        'task_id': task.task_id,
+        'upstream': [
+            task_fingerprint(t) for t in luigi.task.flatten(task.requires())
+        ],
+    })
+
+
+class FingerprintMixin:
+    """Only consider a task complete if its output has a current fingerprint.
+
+    Use before `luigi.Task` in the bases of a task class. Override
+    `fingerprint_config` to include config read by the task which isn't one of
+    its parameters.
+    """
+
+    def fingerprint_config(self):
+        """Return the config which determines this task's output."""
+        params = self.to_str_params(only_significant=True)
+        # Covered by the upstream fingerprints.
+        params.pop('requires_task', None)
+
+        return params
+
+    @cached_property
+    def fingerprint(self):
+        return _hash({
+            'config': self.fingerprint_config(),
+            'code': code_version(type(self).__module__),
+            'upstream': [
+                task_fingerprint(t) for t in luigi.task.flatten(self.requires())
+            ],
+        })
+
+    @property
+    def fingerprint_path(self):
+        return os.path.join(FINGERPRINTS_DIR, self.task_id)
+
+    def recorded_fingerprint(self):
+        stamp = _read_stamp(self.fingerprint_path)
+        if stamp is None:
+            return None
+
+        return stamp['fingerprint']
+
+    def complete(self):
+        return (
+            super().complete()
+            and self.recorded_fingerprint() == self.fingerprint
+        )
+
+    def record_fingerprint(self):
+        os.makedirs(FINGERPRINTS_DIR, exist_ok=True)
+        tmp_path = f'{self.fingerprint_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'fingerprint': self.fingerprint,
+                'outputs': [t.path for t in luigi.task.flatten(self.output())],
+            }, f)
+        os.replace(tmp_path, self.fingerprint_path)
+
+    def remove_stale_output(self):
+        """Remove outputs built with a different fingerprint."""
+        if os.path.isfile(self.fingerprint_path):
+            os.remove(self.fingerprint_path)
+
+        for target in luigi.task.flatten(self.output()):
+            if not target.exists():
+                continue
+
+            logger.info(f'Removing stale output {target.path}...')
+            if os.path.isdir(target.path):
+                shutil.rmtree(target.path)
+            else:
+                os.remove(target.path)
+
+
+@luigi.Task.event_handler(luigi.Event.START)
+def _remove_stale_output(task):
+    if isinstance(task, FingerprintMixin):
+        task.remove_stale_output()
+
+
+@luigi.Task.event_handler(luigi.Event.SUCCESS)
+def _record_fingerprint(task):
+    if isinstance(task, FingerprintMixin):
+        task.record_fingerprint()
@@ -0,0 +1,42 @@
+from contextlib import contextmanager
+
+from osgeo import gdal
+
+
+@contextmanager
+def gdal_config_options(**options):
+    """Set GDAL configuration options, restoring their old values on exit.
+
+    GDAL config options are global to the process. Luigi runs each task in its
+    own process when there is more than one worker, so options set here only
+    affect the running task.
+    """
+    old_values = {key: gdal.GetConfigOption(key) for key in options}
+    try:
+        for key, value in options.items():
+            gdal.SetConfigOption(key, str(value))
+        yield
+    finally:
+        for key, value in old_values.items():
+            # Setting `None` unsets the option.
+            gdal.SetConfigOption(key, value)
+
+
+@contextmanager
+def gdal_cache_max(megabytes):
+    """Set the size of GDAL's raster block cache, restoring it on exit.
+
+    Unlike setting the `GDAL_CACHEMAX` config option, this takes effect even
+    after the cache has been used by earlier GDAL I/O in the process. Does
+    nothing if `megabytes` is None.
+    """
+    if megabytes is None:
+        yield
+        return
+
+    old_value = gdal.GetCacheMax()
+    gdal.SetCacheMax(megabytes * 1024 ** 2)
+    try:
+        yield
+    finally:
+        gdal.SetCacheMax(old_value)
@@ -0,0 +1,215 @@
+"""Content-addressed cache of fetched input files.
+
+Downloaded files are stored once under `INPUT_CACHE_DIR`, named by their
+SHA-256 digest, and hard linked in to the output directory of each fetch task
+that needs them. A manifest records the digest each URL last resolved to,
+along with the HTTP validators (ETag/Last-Modified) used to cheaply check
+whether it has changed, and the configuration each source was fetched with.
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+from contextlib import contextmanager
+
+from humanize import naturalsize
+
+from qgreenland.constants import DOWNLOAD_CHUNK_SIZE, INPUT_CACHE_DIR
+
+logger = logging.getLogger('luigi-interface')
+
+MANIFEST_FP = os.path.join(INPUT_CACHE_DIR, 'manifest.json')
+STATS_FP = os.path.join(INPUT_CACHE_DIR, 'stats.json')
+LOCK_FP = os.path.join(INPUT_CACHE_DIR, '.lock')
+
+EMPTY_STATS = {
+    'hits': 0,
+    'misses': 0,
+    'bytes_downloaded': 0,
+    'bytes_saved': 0,
+    'bytes_deduplicated': 0,
+}
+
+
+def _read_json(fp):
+    # Writes are atomic, so reading doesn't need the lock.
+    try:
+        with open(fp) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+@contextmanager
+def _locked_json(fp):
+    """Yield the contents of JSON file `fp` for update, then write it back.
+
+    The lock is shared by every thread and process using the cache.
+    """
+    os.makedirs(INPUT_CACHE_DIR, exist_ok=True)
+    with open(LOCK_FP, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            data = _read_json(fp)
+            yield data
+
+            tmp_fp = f'{fp}.tmp'
+            with open(tmp_fp, 'w') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+            os.replace(tmp_fp, fp)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _sha256(fp):
+    digest = hashlib.sha256()
+    with open(fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _update_stats(**increments):
+    with _locked_json(STATS_FP) as stats:
+        for key, value in increments.items():
+            stats[key] = stats.get(key, 0) + value
+
+
+def blob_path(entry):
+    """Return the path to the cached file for a manifest entry."""
+    digest = entry['sha256']
+    return os.path.join(INPUT_CACHE_DIR, 'sha256', digest[:2], digest)
+
+
+def lookup(url):
+    """Return the manifest entry for `url` if its file is still cached."""
+    entry = _read_json(MANIFEST_FP).get('urls', {}).get(url)
+    if entry and os.path.isfile(blob_path(entry)):
+        return entry
+
+    return None
+
+
+def store(url, fp, *, filename, etag=None, last_modified=None):
+    """Move the completed download `fp` of `url` in to the cache.
+
+    Files whose content is already cached (e.g. the same file served from two
+    URLs) are stored only once. Returns the new manifest entry for `url`.
+    """
+    size = os.path.getsize(fp)
+    entry = {
+        'sha256': _sha256(fp),
+        'filename': filename,
+        'size': size,
+        'etag': etag,
+        'last_modified': last_modified,
+    }
+
+    cached_fp = blob_path(entry)
+    # Under the lock, so `prune` can't remove the file before it's recorded.
+    with _locked_json(MANIFEST_FP) as manifest:
+        deduplicated = os.path.isfile(cached_fp)
+        if deduplicated:
+            logger.info(f'Content of {url} is already cached as {cached_fp}.')
+            os.remove(fp)
+        else:
+            os.makedirs(os.path.dirname(cached_fp), exist_ok=True)
+            # Cached files are hard linked in to task outputs; make sure
+            # nothing can modify them in place.
+            os.chmod(fp, 0o444)
+            os.replace(fp, cached_fp)
+
+        manifest.setdefault('urls', {})[url] = entry
+
+    _update_stats(misses=1,
+                  bytes_downloaded=size,
+                  bytes_deduplicated=size if deduplicated else 0)
+
+    return entry
+
+
+def record_hit(entry):
+    """Count a cached file which was used without downloading it again."""
+    _update_stats(hits=1, bytes_saved=entry['size'])
+
+
+def source_signature(source_cfg_str):
+    """Hash a serialized source configuration."""
+    return hashlib.sha256(source_cfg_str.encode('utf-8')).hexdigest()
+
+
+def source_is_current(source_key, signature):
+    """Check whether a source was last fetched with the same configuration.
+
+    Sources fetched before the manifest existed are assumed to be current.
+    """
+    recorded = _read_json(MANIFEST_FP).get('sources', {}).get(source_key)
+
+    return recorded is None or recorded['signature'] == signature
+
+
+def record_source(source_key, signature, *, urls=()):
+    """Record the configuration and files a source was fetched with."""
+    with _locked_json(MANIFEST_FP) as manifest:
+        cached_urls = manifest.get('urls', {})
+        manifest.setdefault('sources', {})[source_key] = {
+            'signature': signature,
+            'files': {
+                url: cached_urls[url]['sha256']
+                for url in urls if url in cached_urls
+            },
+        }
+
+
+def prune(*, source_keys):
+    """Remove cached files which no source in `source_keys` was fetched with.
+
+    Manifest records of other sources, and of URLs they alone used, are
+    removed too. Returns the number of bytes freed.
+    """
+    with _locked_json(MANIFEST_FP) as manifest:
+        manifest['sources'] = {
+            key: source for key, source in manifest.get('sources', {}).items()
+            if key in source_keys
+        }
+        used_urls = {
+            url for source in manifest['sources'].values()
+            for url in source['files']
+        }
+        manifest['urls'] = {
+            url: entry for url, entry in manifest.get('urls', {}).items()
+            if url in used_urls
+        }
+        used_digests = {entry['sha256'] for entry in manifest['urls'].values()}
+
+        freed = 0
+        blobs_dir = os.path.join(INPUT_CACHE_DIR, 'sha256')
+        for dirpath, _, filenames in os.walk(blobs_dir):
+            for digest in set(filenames) - used_digests:
+                fp = os.path.join(dirpath, digest)
+                freed += os.path.getsize(fp)
+                os.remove(fp)
+
+    logger.info(f'Input cache: pruned {naturalsize(freed)} of unused files.')
+
+    return freed
+
+
+def log_stats(*, reset=True):
+    """Log cache hit/miss counts and bytes saved since the last reset."""
+    with _locked_json(STATS_FP) as stats:
+        current = {**EMPTY_STATS, **stats}
+        if reset:
+            stats.clear()
+
+    logger.info(
+        f"Input cache: {current['hits']} hits, {current['misses']} misses."
+        f" Downloaded {naturalsize(current['bytes_downloaded'])}, saved"
+        f" {naturalsize(current['bytes_saved'])} of downloads and"
+        f" {naturalsize(current['bytes_deduplicated'])} of duplicate storage."
+    )
+
+    return current
@@ -1,13 +1,60 @@
+import logging
 import os
 import shutil
+from collections import Counter
 
 import luigi
+import luigi.interface
 
 from qgreenland.constants import CONFIG, TaskType
-from qgreenland.util.misc import get_layer_dir, get_layer_fn, temporary_path_dir
+from qgreenland.util.build_cache import get_build_cache
+from qgreenland.util.fingerprint import FingerprintMixin
+from qgreenland.util.misc import (
+    find_single_file_by_ext,
+    get_layer_dir,
+    get_layer_fn,
+    link_or_copy_file,
+    temporary_path_dir
+)
 
+logger = logging.getLogger('luigi-interface')
 
-class LayerTask(luigi.Task):
+
+def cpus_per_worker():
+    """Return the number of CPUs each luigi worker can use.
+
+    Each task runs alongside up to `--workers` others, so tasks use their share
+    of the CPUs, rather than all of them, for multithreaded work.
+    """
+    return max(1, os.cpu_count() // luigi.interface.core().workers)
+
+
+def count_task_references(tasks):
+    """Count how often each task family is required in the graph of `tasks`.
+
+    Returns a pair of Counters, keyed by task family: the number of times a
+    task is required (including `tasks` themselves), and the number of unique
+    tasks. Luigi runs each unique task once, so the difference is the number
+    of stages shared rather than repeated.
+    """
+    references = Counter()
+    unique = Counter()
+    seen = set()
+    to_visit = list(tasks)
+    while to_visit:
+        task = to_visit.pop()
+        references[task.task_family] += 1
+        if task.task_id in seen:
+            continue
+
+        seen.add(task.task_id)
+        unique[task.task_family] += 1
+        to_visit.extend(luigi.task.flatten(task.requires()))
+
+    return references, unique
+
+
+class LayerTask(FingerprintMixin, luigi.Task):
     """Allow tasks to receive layer_id as parameter and get the correct config.
 
     Used for all tasks that require a layer config. This way, we only have to
@@ -18,9 +65,35 @@ class LayerTask(luigi.Task):
     layer_id = luigi.Parameter()
     task_type = None
 
+    # Resources (see `[resources]` in `luigi.toml`) used by one instance of
+    # this task. Layers can override the amounts with `resources` in their
+    # config. Tasks which declare nothing are only limited by worker count.
+    default_resources = {}
+    default_priority = 0
+
+    @property
+    def resources(self):
+        estimates = self.layer_cfg.get('resources', {})
+        return {
+            name: estimates.get(name, amount)
+            for name, amount in self.default_resources.items()
+        }
+
+    @property
+    def priority(self):
+        return self.layer_cfg.get('priority', self.default_priority)
+
     def requires(self):
         return self.requires_task
 
+    def fingerprint_config(self):
+        return {
+            **super().fingerprint_config(),
+            'layer': self.layer_cfg,
+            # E.g. the CRS and extents.
+            'project': CONFIG['project'],
+        }
+
     @property
     def layer_cfg(self):
         return CONFIG['layers'][self.layer_id]
@@ -35,30 +108,46 @@ class LayerTask(luigi.Task):
 
     @property
     def outdir(self):
-        # We could possibly DRY this out by adding a task_type param to
-        # get_layer_path
+        """Return the directory this task's output is written under.
+
+        Only computes the path; the directory is created when the output is
+        written (see `temporary_path_dir`).
+        """
         if self.task_type not in TaskType:
             msg = (f"This class defines self.task_type as '{self.task_type}'. "
                    f'Must be one of: {list(TaskType)}.')
             raise RuntimeError(msg)
 
         if self.task_type is TaskType.FINAL:
-            outdir = (f"{TaskType.FINAL.value}/{self.layer_cfg['layer_group']}/"
-                      f'{self.id}')
-        else:
-            outdir = f'{self.task_type.value}/{self.id}'
+            # Must match the path `get_layer_path` expects.
+            return get_layer_dir(self.layer_cfg)
+
+        return os.path.join(self.task_type.value, self.id)
+
+    def find_input_file(self, *, ext):
+        """Return this layer's file with extension `ext` in the input dir.
+
+        Tasks shared by the layers of one data source write a file per layer,
+        named by layer id. Otherwise, the input must contain a single file with
+        a matching extension.
+        """
+        layer_fp = os.path.join(self.input().path, f'{self.id}{ext}')
+        if os.path.isfile(layer_fp):
+            return layer_fp
 
-        os.makedirs(outdir, exist_ok=True)
-        return outdir
+        return find_single_file_by_ext(self.input().path, ext=ext)
 
     # TODO: Standardize the output method of layer tasks
     # def output(self):
 
 
-class LayerPipeline(luigi.Task):
+class LayerPipeline(FingerprintMixin, luigi.Task):
     """Allow top-level layer tasks to lookup config from class attr layer_id.
 
     Also standardizes output directory for top-level layer tasks.
+
+    If a build cache is configured, a layer built with the same fingerprint
+    is restored from it rather than rebuilt, and new builds are stored in it.
     """
 
     layer_id = luigi.Parameter()
@@ -67,9 +156,47 @@ class LayerPipeline(luigi.Task):
     def cfg(self):
         return CONFIG['layers'][self.layer_id]
 
+    @property
+    def priority(self):
+        # Luigi propagates priority to the tasks this one depends on.
+        return self.cfg.get('priority', 0)
+
+    def fingerprint_config(self):
+        return {**super().fingerprint_config(), 'layer': self.cfg}
+
     def output(self):
         return luigi.LocalTarget(get_layer_dir(self.cfg))
 
+    def complete(self):
+        # Restoring here, rather than in `run`, means the tasks this one
+        # requires aren't run either.
+        return super().complete() or self.restore_from_build_cache()
+
+    def restore_from_build_cache(self):
+        build_cache = get_build_cache()
+        if build_cache is None or not build_cache.contains(self.fingerprint):
+            return False
+
+        self.remove_stale_output()
+        if not build_cache.restore(self.fingerprint, self.output().path):
+            return False
+
+        logger.info(f'Restored {self.layer_id} from the build cache.')
+        self.record_fingerprint()
+
+        return True
+
+    def store_in_build_cache(self):
+        build_cache = get_build_cache()
+        if build_cache is None:
+            return
+
+        try:
+            build_cache.store(self.fingerprint, self.output().path)
+        except OSError as e:
+            # The layer is built; it just won't be shared.
+            logger.warning(f'Failed to store {self.layer_id} in the build cache: {e}')
+
     def run(self):
         if os.path.isdir(self.input().path):
             source_path = self.input().path
@@ -77,4 +204,10 @@ class LayerPipeline(luigi.Task):
             source_path = os.path.dirname(self.input().path)
 
         with temporary_path_dir(self.output()) as temp_path:
-            shutil.copytree(source_path, temp_path, dirs_exist_ok=True)
+            # WIP outputs aren't modified after they're written, so link them
+            # in to place rather than copying.
+            shutil.copytree(source_path, temp_path,
+                            copy_function=link_or_copy_file,
+                            dirs_exist_ok=True)
+
+        self.store_in_build_cache()
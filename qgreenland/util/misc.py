@@ -1,18 +1,44 @@
 import cgi
 import glob
+import hashlib
+import json
+import logging
 import os
 import re
 import shutil
+import threading
 import time
+import urllib.parse
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import closing, contextmanager
 
-from qgreenland.constants import (RELEASES_DIR,
+from humanize import naturalsize
+
+from qgreenland.constants import (DOWNLOAD_CHUNK_SIZE,
+                                  MAX_CONNECTIONS_PER_HOST,
+                                  RELEASES_DIR,
                                   REQUEST_TIMEOUT,
+                                  SOURCES_WIP_DIR,
                                   TaskType,
                                   WIP_DIR,
                                   ZIP_TRIGGERFILE)
-from qgreenland.util.edl import create_earthdata_authenticated_session
+from qgreenland.util import input_cache
+from qgreenland.util.edl import get_earthdata_authenticated_session
+from qgreenland.util.fingerprint import recorded_outputs
+
+try:
+    # A drop-in, much faster, replacement for `gzip` when available.
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
+logger = logging.getLogger('luigi-interface')
+
+# Bound the number of simultaneous downloads from each host, across all
+# fetches running in this process.
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
 
 
 def _filename_from_url(url):
@@ -25,62 +51,401 @@ def _filename_from_url(url):
     return fn
 
 
-def _ftp_fetch_and_write(url, output_dir):
-    # TODO support earthdata login
-    fn = _filename_from_url(url)
-    fp = os.path.join(output_dir, fn)
+def _write_chunks(chunks, fp, *, mode='wb'):
+    """Write an iterable of bytes to `fp` and log the download rate.
+
+    Only one chunk is held in memory at a time. Use `mode='ab'` to append to
+    an existing file. Returns the number of bytes written.
+    """
+    start = time.monotonic()
+    num_bytes = 0
+
+    with open(fp, mode) as f:
+        for chunk in chunks:
+            # `iter_content` may yield empty keep-alive chunks.
+            if chunk:
+                f.write(chunk)
+                num_bytes += len(chunk)
+
+    elapsed = time.monotonic() - start
+    rate = num_bytes / elapsed if elapsed else num_bytes
+    logger.info(
+        f'Wrote {naturalsize(num_bytes)} to {fp} in {elapsed:.1f}s'
+        f' ({naturalsize(rate)}/s).'
+    )
 
+    return num_bytes
+
+
+def _ftp_fetch_and_write(url, fp, *, chunk_size):
+    # TODO support earthdata login
     # Stolen from:
     # https://stackoverflow.com/questions/11768214/python-download-a-file-from-an-ftp-server
     # TODO: do we need `closing`?
     with closing(urllib.request.urlopen(url)) as r:
-        with open(fp, 'wb') as f:
-            shutil.copyfileobj(r, f)
+        _write_chunks(iter(lambda: r.read(chunk_size), b''), fp)
+
+
+def _filename_from_response(resp, url):
+    """Get the output filename from the response headers or the URL."""
+    # Try to extract the filename from the `content-disposition` header
+    if (
+        (disposition := resp.headers.get('content-disposition'))
+        and 'filename' in disposition
+    ):
+        # Sometimes the filename is quoted, sometimes it's not.
+        parsed = cgi.parse_header(disposition)
+        # Handle case where disposition itself (usually "attachment") isn't
+        # present (geothermal heat flux :bell:).
+        if 'filename' in parsed[0]:
+            return re.match(
+                'filename="?(.*)"?',
+                parsed[0]
+            ).groups()[0].strip('\'"')
+        else:
+            return parsed[1]['filename']
 
+    if not (fn := _filename_from_url(url)):
+        raise RuntimeError(f'Failed to retrieve output filename from {url}')
 
-def fetch_and_write_file(url, *, output_dir, session=None):
-    """Attempt to download and write file from url.
+    return fn
+
+
+def _staged_download_paths(url, staging_dir):
+    """Return paths of the (partial) download of `url` and its state file."""
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    return (os.path.join(staging_dir, f'{key}.part'),
+            os.path.join(staging_dir, f'{key}.json'))
 
-    Assumes filename from URL or content-disposition header.
+
+def _read_download_state(state_fp):
+    try:
+        with open(state_fp) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_download_state(state_fp, state):
+    tmp_fp = f'{state_fp}.tmp'
+    with open(tmp_fp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_fp, state_fp)
+
+
+def _resume_headers(state, offset):
+    """Build headers requesting the remainder of a partial download.
+
+    `If-Range` makes the server send the whole file instead if it has changed
+    since the partial download started. Weak ETags can't be used with
+    `If-Range`, so fall back to `Last-Modified` for those.
     """
-    if url.startswith('ftp://'):
-        _ftp_fetch_and_write(url, output_dir)
+    if not (offset and state.get('accept_ranges')):
+        return {}
+
+    validator = state.get('etag')
+    if not validator or validator.startswith('W/'):
+        validator = state.get('last_modified')
+
+    if not validator:
+        return {}
+
+    return {'Range': f'bytes={offset}-', 'If-Range': validator}
+
+
+def _conditional_headers(cached):
+    """Build headers asking the server to skip sending an unchanged file."""
+    headers = {}
+    if not cached:
+        return headers
+
+    if cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+
+    return headers
+
+
+def _is_identity_encoded(resp):
+    # `requests` transparently decodes e.g. gzip-encoded bodies, so byte
+    # offsets and lengths from the headers don't match what we write.
+    return resp.headers.get('content-encoding', 'identity') == 'identity'
+
+
+def _expected_length(resp):
+    """Return the full size of the file being downloaded, if known."""
+    if not _is_identity_encoded(resp):
+        return None
+
+    if resp.status_code == 206:
+        # e.g. "bytes 1000-4999/5000"
+        length = resp.headers.get('content-range', '').rsplit('/', 1)[-1]
     else:
-        # TODO: Share the session across requests somehow?
-        if not session:
-            session = create_earthdata_authenticated_session(hosts=[url])
+        length = resp.headers.get('content-length', '')
+
+    return int(length) if length.isdigit() else None
+
+
+def _can_resume_from(resp, *, offset, state):
+    """Check that a `206` response continues our partial download."""
+    if resp.status_code != 206:
+        return False
+
+    match = re.match(r'bytes (\d+)-', resp.headers.get('content-range', ''))
+    if not (match and int(match.groups()[0]) == offset):
+        return False
 
-        resp = session.get(url, timeout=REQUEST_TIMEOUT)
+    etag = resp.headers.get('etag')
+    return not (etag and state.get('etag') and etag != state['etag'])
 
-        # Try to extract the filename from the `content-disposition` header
-        if (
-            (disposition := resp.headers.get('content-disposition'))
-            and 'filename' in disposition
+
+def _discard_staged_download(part_fp, state_fp):
+    for fp in (part_fp, state_fp):
+        if os.path.isfile(fp):
+            os.remove(fp)
+
+
+def _fetch_to_staging(url, *, staging_dir, session, chunk_size, cached=None):
+    """Download `url` in to `staging_dir`, resuming any partial download.
+
+    Partial downloads, and a small JSON file recording the response
+    validators (ETag/Last-Modified) and expected length, are kept in
+    `staging_dir` when a download fails, so the next attempt can request only
+    the remaining bytes.
+
+    If `cached` (an input cache manifest entry) is given, the request is made
+    conditional on the file having changed since it was cached.
+
+    Returns the path to the completed download and its recorded state, or
+    `None` if the cached file is still current.
+    """
+    os.makedirs(staging_dir, exist_ok=True)
+    part_fp, state_fp = _staged_download_paths(url, staging_dir)
+    state = _read_download_state(state_fp)
+    offset = os.path.getsize(part_fp) if os.path.isfile(part_fp) else 0
+
+    # The completed download may since have been moved in to the input cache.
+    if (state.get('complete') and os.path.isfile(part_fp)
+            and offset == state.get('length', offset)):
+        logger.info(f'Using previously-completed download of {url}.')
+        return part_fp, state
+
+    headers = _resume_headers(state, offset) or _conditional_headers(cached)
+    with session.get(url,
+                     headers=headers,
+                     timeout=REQUEST_TIMEOUT,
+                     stream=True) as resp:
+        if resp.status_code == 304:
+            return None
+
+        if resp.status_code in (206, 416) and not _can_resume_from(
+            resp, offset=offset, state=state
         ):
-            # Sometimes the filename is quoted, sometimes it's not.
-            parsed = cgi.parse_header(disposition)
-            # Handle case where disposition itself (usually "attachment") isn't
-            # present (geothermal heat flux :bell:).
-            if 'filename' in parsed[0]:
-                fn = re.match(
-                    'filename="?(.*)"?',
-                    parsed[0]
-                ).groups()[0].strip('\'"')
-            else:
-                fn = parsed[1]['filename']
+            logger.info(f'Server did not resume {url}; restarting download.')
+            _discard_staged_download(part_fp, state_fp)
+            return _fetch_to_staging(url,
+                                     staging_dir=staging_dir,
+                                     session=session,
+                                     chunk_size=chunk_size,
+                                     cached=cached)
+
+        if resp.status_code == 206:
+            logger.info(f'Resuming download of {url} from byte {offset}.')
+            mode = 'ab'
+        elif resp.status_code == 200:
+            mode = 'wb'
+            state = {
+                'url': url,
+                'filename': _filename_from_response(resp, url),
+                'etag': resp.headers.get('etag'),
+                'last_modified': resp.headers.get('last-modified'),
+                'accept_ranges': (resp.headers.get('accept-ranges') == 'bytes'
+                                  and _is_identity_encoded(resp)),
+            }
         else:
-            if not (fn := _filename_from_url(url)):
-                raise RuntimeError(f'Failed to retrieve output filename from {url}')
+            msg = (f"Received '{resp.status_code}' from {resp.request.url}."
+                   f'Content: {resp.text}')
+            raise RuntimeError(msg)
+
+        if (length := _expected_length(resp)) is not None:
+            state['length'] = length
+        _write_download_state(state_fp, state)
+
+        _write_chunks(resp.iter_content(chunk_size=chunk_size), part_fp, mode=mode)
+
+    size = os.path.getsize(part_fp)
+    if 'length' in state and size != state['length']:
+        raise RuntimeError(
+            f"Download of {url} is incomplete ({size} of {state['length']}"
+            ' bytes). Re-run the task to resume it.'
+        )
+
+    state['complete'] = True
+    _write_download_state(state_fp, state)
+
+    return part_fp, state
+
+
+def link_or_copy_file(src, dst):
+    """Hard link `src` to `dst`, falling back to a copy across filesystems."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _host_semaphore(url):
+    host = urllib.parse.urlparse(url).netloc
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(
+                MAX_CONNECTIONS_PER_HOST
+            )
+
+        return _host_semaphores[host]
 
-        fp = os.path.join(output_dir, fn)
 
+def _download_to_staging(url, *, staging_dir, session, chunk_size, cached):
+    """Download `url` in to `staging_dir` unless `cached` is still current.
+
+    Returns the path to the completed download and its recorded state, or
+    `None` if the cached file can be used instead.
+    """
+    if url.startswith('ftp://'):
+        if cached:
+            # There's no cheap way to check FTP files for changes, so assume
+            # a cached file is still current.
+            return None
+
+        # FTP downloads can't be resumed, so they're always staged whole.
+        os.makedirs(staging_dir, exist_ok=True)
+        staged_fp, _ = _staged_download_paths(url, staging_dir)
+        _ftp_fetch_and_write(url, staged_fp, chunk_size=chunk_size)
+
+        return staged_fp, {'filename': _filename_from_url(url)}
+
+    if not session:
+        session = get_earthdata_authenticated_session(url)
+
+    return _fetch_to_staging(url,
+                             staging_dir=staging_dir,
+                             session=session,
+                             chunk_size=chunk_size,
+                             cached=cached)
+
+
+def _stage_file(url, *, staging_dir, session, chunk_size, use_cache=False):
+    """Download `url` in to `staging_dir`, or the input cache.
+
+    With `use_cache`, unchanged files are taken from the input cache instead
+    of being downloaded again, and new downloads are moved in to it.
+
+    Returns the output filename and the path to the completed download.
+    """
+    with _host_semaphore(url):
+        cached = input_cache.lookup(url) if use_cache else None
+        staged = _download_to_staging(url,
+                                      staging_dir=staging_dir,
+                                      session=session,
+                                      chunk_size=chunk_size,
+                                      cached=cached)
+
+    if staged is None:
+        logger.info(f'Using cached copy of {url}.')
+        input_cache.record_hit(cached)
+        return cached['filename'], input_cache.blob_path(cached)
+
+    staged_fp, state = staged
+    if not use_cache:
+        return state['filename'], staged_fp
+
+    entry = input_cache.store(url,
+                              staged_fp,
+                              filename=state['filename'],
+                              etag=state.get('etag'),
+                              last_modified=state.get('last_modified'))
+    # The staged file was moved in to the cache, so its state no longer
+    # describes anything.
+    _, state_fp = _staged_download_paths(url, staging_dir)
+    if os.path.isfile(state_fp):
+        os.remove(state_fp)
+
+    return entry['filename'], input_cache.blob_path(entry)
+
+
+def fetch_and_write_file(url, *, output_dir, session=None, staging_dir=None,
+                         chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Attempt to download and write file from url.
+
+    Assumes filename from URL or content-disposition header. The response body
+    is streamed to disk `chunk_size` bytes at a time.
+
+    If `staging_dir` is given, the file is downloaded there first and linked
+    in to `output_dir` once it's complete. Interrupted downloads are left in
+    `staging_dir` to be resumed, so the caller should remove it once all of
+    its files have been promoted.
+    """
+    if staging_dir:
+        fn, staged_fp = _stage_file(url,
+                                    staging_dir=staging_dir,
+                                    session=session,
+                                    chunk_size=chunk_size)
+        link_or_copy_file(staged_fp, os.path.join(output_dir, fn))
+        return
+
+    if url.startswith('ftp://'):
+        fp = os.path.join(output_dir, _filename_from_url(url))
+        _ftp_fetch_and_write(url, fp, chunk_size=chunk_size)
+        return
+
+    if not session:
+        session = get_earthdata_authenticated_session(url)
+
+    with session.get(url, timeout=REQUEST_TIMEOUT, stream=True) as resp:
         if resp.status_code != 200:
             msg = (f"Received '{resp.status_code}' from {resp.request.url}."
                    f'Content: {resp.text}')
             raise RuntimeError(msg)
 
-        with open(fp, 'wb') as f:
-            f.write(resp.content)
+        fn = _filename_from_response(resp, url)
+        fp = os.path.join(output_dir, fn)
+
+        _write_chunks(resp.iter_content(chunk_size=chunk_size), fp)
+
+
+def fetch_and_write_files(urls, *, output_dir, staging_dir, session=None,
+                          max_workers=1, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Download all `urls` using up to `max_workers` threads.
+
+    Every file is downloaded to `staging_dir` before any of them are linked in
+    to `output_dir`, so `output_dir` is only populated if all downloads
+    succeed. Downloads from any one host are additionally limited to
+    `MAX_CONNECTIONS_PER_HOST` at a time.
+
+    Files go through the content-addressed input cache, so files which are
+    unchanged since they were last fetched aren't downloaded again.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(_stage_file,
+                            url,
+                            staging_dir=staging_dir,
+                            session=session,
+                            chunk_size=chunk_size,
+                            use_cache=True)
+            for url in urls
+        ]
+
+        try:
+            staged = [future.result() for future in as_completed(futures)]
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+
+    for fn, staged_fp in staged:
+        link_or_copy_file(staged_fp, os.path.join(output_dir, fn))
 
 
 def find_in_dir_by_ext(path, *, ext):
@@ -111,15 +476,103 @@ def find_single_file_by_ext(path, *, ext):
         raise RuntimeError(f"No files with extension '{ext}' found at '{path}'")
 
 
+def _member_is_dir(info):
+    # `rarfile` < 4 names this `isdir`.
+    is_dir = getattr(info, 'is_dir', None) or info.isdir
+    return is_dir()
+
+
+def _member_output_path(output_dir, name):
+    output_dir = os.path.realpath(output_dir)
+    member_fp = os.path.realpath(os.path.join(output_dir, name))
+    if not member_fp.startswith(output_dir + os.sep):
+        raise RuntimeError(f"Archive member '{name}' is outside the archive.")
+
+    return member_fp
+
+
+def extract_members(archive_fp, output_dir, *, open_archive, select=None,
+                    max_workers=1, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Extract members of an archive, streaming each in to `output_dir`.
+
+    `open_archive` opens `archive_fp`, e.g. `zipfile.ZipFile`. Members for
+    which `select(name)` is true are extracted, or every member if none are.
+    Members are extracted in parallel, each thread with its own archive handle.
+
+    Returns the names of the extracted members.
+    """
+    with closing(open_archive(archive_fp)) as archive:
+        members = [
+            info.filename for info in archive.infolist()
+            if not _member_is_dir(info)
+        ]
+
+    selected = [name for name in members if select and select(name)]
+    if not selected:
+        if select:
+            logger.info(f'No members of {archive_fp} selected; extracting all.')
+        selected = members
+
+    local = threading.local()
+    opened = []
+
+    def extract(name):
+        if not hasattr(local, 'archive'):
+            local.archive = open_archive(archive_fp)
+            opened.append(local.archive)
+
+        member_fp = _member_output_path(output_dir, name)
+        os.makedirs(os.path.dirname(member_fp), exist_ok=True)
+        with local.archive.open(name) as src, open(member_fp, 'wb') as dst:
+            shutil.copyfileobj(src, dst, chunk_size)
+
+    logger.info(f'Extracting {len(selected)} of {len(members)} members'
+                f' of {archive_fp}...')
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for future in [executor.submit(extract, n) for n in selected]:
+                future.result()
+    finally:
+        for archive in opened:
+            archive.close()
+
+    return selected
+
+
+def gunzip_file(gzip_fp, output_fp, *, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Decompress `gzip_fp` to `output_fp` without reading it all in to memory."""
+    with gzip.open(gzip_fp, 'rb') as src, open(output_fp, 'wb') as dst:
+        shutil.copyfileobj(src, dst, chunk_size)
+
+
 @contextmanager
-def temporary_path_dir(target):
+def temporary_path(target):
+    """Yield a temporary path which is moved to `target` on success.
+
+    Safe to use from parallel workers, unlike luigi's `temporary_path`, because
+    the target's parent directory is created first. Luigi checks for it and then
+    creates it, which can fail when another worker creates the same directory
+    (e.g. a shared layer group directory) in between.
+    """
+    os.makedirs(os.path.dirname(target.path.rstrip('/')), exist_ok=True)
     with target.temporary_path() as p:
+        yield p
+
+
+@contextmanager
+def temporary_path_dir(target):
+    """Yield a temporary directory which is moved to `target` on success.
+
+    If an exception is raised, the temporary directory is removed so a
+    partially-written output is never left behind.
+    """
+    with temporary_path(target) as p:
         try:
             os.makedirs(p, exist_ok=True)
             yield p
-        finally:
-            pass
-    return
+        except Exception:
+            shutil.rmtree(p, ignore_errors=True)
+            raise
 
 
 def _rmtree(directory, *, retries=3):
@@ -142,8 +595,12 @@ def _rmtree(directory, *, retries=3):
         shutil.rmtree(directory)
 
 
-def cleanup_intermediate_dirs(delete_fetch_dir=False):
-    """Delete all intermediate data, except maybe 'fetch' dir."""
+def cleanup_intermediate_dirs(delete_fetch_dir=False, delete_final_dir=True):
+    """Delete all intermediate data, except maybe 'fetch' and 'final' dirs.
+
+    Keeping the 'final' dir allows the next build to reuse unchanged layers.
+    Their fingerprints (see `qgreenland.util.fingerprint`) are always kept.
+    """
     if delete_fetch_dir:
         _rmtree(WIP_DIR)
         return
@@ -151,9 +608,13 @@ def cleanup_intermediate_dirs(delete_fetch_dir=False):
     if os.path.isfile(ZIP_TRIGGERFILE):
         os.remove(ZIP_TRIGGERFILE)
 
-    for task_type in TaskType:
-        if task_type != TaskType.FETCH:
-            _rmtree(task_type.value)
+    kept_task_types = {TaskType.FETCH}
+    if not delete_final_dir:
+        kept_task_types.add(TaskType.FINAL)
+
+    for task_type in set(TaskType) - kept_task_types:
+        _rmtree(task_type.value)
+    _rmtree(SOURCES_WIP_DIR)
 
     if os.path.isdir(WIP_DIR):
         for x in os.listdir(WIP_DIR):
@@ -161,6 +622,39 @@ def cleanup_intermediate_dirs(delete_fetch_dir=False):
                 _rmtree(x)
 
 
+def prune_final_dir(*, layer_dirs):
+    """Delete layer directories in the 'final' dir which aren't in `layer_dirs`.
+
+    Only directories stamped as a task's output (i.e. created by the
+    pipeline) are deleted, along with their stamps. Files (e.g. the QGIS
+    project), the layer group directories containing `layer_dirs`, and
+    anything else put in the 'final' dir by hand are kept.
+    """
+    layer_dirs = {os.path.normpath(d) for d in layer_dirs}
+    stamped_outputs = recorded_outputs()
+
+    to_remove = []
+    for dirpath, dirnames, _ in os.walk(TaskType.FINAL.value):
+        for dirname in list(dirnames):
+            path = os.path.normpath(os.path.join(dirpath, dirname))
+            if path in stamped_outputs and path not in layer_dirs:
+                to_remove.append(path)
+            if path in stamped_outputs or path in layer_dirs:
+                # Don't descend in to layers.
+                dirnames.remove(dirname)
+
+    if not to_remove:
+        return
+
+    logger.info(
+        'Removing layer directories no longer in the layer config:\n'
+        + '\n'.join(f'  {path}' for path in to_remove),
+    )
+    for path in to_remove:
+        _rmtree(path)
+        os.remove(stamped_outputs[path])
+
+
 def cleanup_output_dirs(delete_fetch_dir=False):
     """Delete all output dirs (intermediate and release).
 
@@ -1,14 +1,29 @@
 import logging
-import subprocess
+import math
 
 import pyproj
 from osgeo import gdal
 from osgeo.gdalconst import GA_ReadOnly
 
 from qgreenland.constants import CONFIG
+from qgreenland.util.extent import transform_extent
+from qgreenland.util.gdal import gdal_cache_max, gdal_config_options
+from qgreenland.util.luigi import cpus_per_worker
 
 logger = logging.getLogger('luigi-interface')
 
+# Resampling methods supported by `gdal.Dataset.BuildOverviews`.
+OVERVIEW_RESAMPLING_METHODS = (
+    'NEAREST', 'AVERAGE', 'GAUSS', 'CUBIC', 'CUBICSPLINE', 'LANCZOS',
+    'MODE', 'AVERAGE_MAGPHASE', 'NONE',
+)
+
+COG_DEFAULTS = {
+    'compress': 'DEFLATE',
+    'blocksize': 512,
+    'resampling': 'average',
+}
+
 
 def _get_raster_srs(fp):
     """Read a raster with GDAL and return its SRS or None."""
@@ -37,11 +52,223 @@ def _get_raster_srs(fp):
         return None
 
 
-def warp_raster(inp_path, out_path, *, layer_cfg, warp_kwargs=None):
+def merge_warp_options(*option_lists):
+    """Merge lists of `KEY=VALUE` warp options; later lists take precedence."""
+    merged = {}
+    for options in option_lists:
+        for option in options:
+            key, _, value = option.partition('=')
+            merged[key.upper()] = value
+
+    return [f'{key}={value}' for key, value in merged.items()]
+
+
+def overview_levels(width, height, *, min_size=256):
+    """Return overview factors, halving until the overview fits `min_size`."""
+    levels = []
+    factor = 2
+    while max(width, height) / factor >= min_size:
+        levels.append(factor)
+        factor *= 2
+
+    # Always build at least one overview.
+    return levels or [2]
+
+
+def has_overviews(fp):
+    """Check whether the first band of raster `fp` has overviews."""
+    ds = gdal.Open(fp, GA_ReadOnly)
+    return ds.GetRasterBand(1).GetOverviewCount() > 0
+
+
+def build_overviews(fp, *, levels=None, resampling='average'):
+    """Build compressed overviews inside GeoTIFF `fp`.
+
+    `fp` is modified in place, so must not be linked to another task's output.
+    Overview levels are chosen from the raster size if not given.
+    """
+    ds = gdal.Open(fp, gdal.GA_Update)
+    if levels is None:
+        levels = overview_levels(ds.RasterXSize, ds.RasterYSize)
+
+    logger.info(f'Building overviews {levels} for {fp}...')
+    with gdal_config_options(COMPRESS_OVERVIEW='DEFLATE',
+                             GDAL_NUM_THREADS=cpus_per_worker()):
+        result = ds.BuildOverviews(resampling.upper(), list(levels))
+
+    # Flush the overviews to disk.
+    del ds
+
+    if result != 0:
+        raise RuntimeError(f'Failed to build overviews for {fp}.')
+
+
+def _cog_creation_options(cog_kwargs, *, cog_driver, creation_options=()):
+    """Return creation options for a COG, with the layer's `creation_options`.
+
+    Raises a RuntimeError if a layer option conflicts with one set from
+    `cog_kwargs`.
+    """
+    options = [
+        f"COMPRESS={cog_kwargs['compress']}",
+        f'NUM_THREADS={cpus_per_worker()}',
+    ]
+    if 'predictor' in cog_kwargs:
+        options.append(f"PREDICTOR={cog_kwargs['predictor']}")
+
+    if cog_driver:
+        options += [
+            f"BLOCKSIZE={cog_kwargs['blocksize']}",
+            f"OVERVIEW_RESAMPLING={cog_kwargs['resampling'].upper()}",
+        ]
+    else:
+        options += [
+            'TILED=YES',
+            f"BLOCKXSIZE={cog_kwargs['blocksize']}",
+            f"BLOCKYSIZE={cog_kwargs['blocksize']}",
+        ]
+
+    cog_options = dict(option.partition('=')[::2] for option in options)
+    for option in creation_options:
+        key, _, value = option.partition('=')
+        if cog_options.get(key.upper(), value) != value:
+            raise RuntimeError(
+                f"Creation option '{option}' conflicts with '{key.upper()}="
+                f"{cog_options[key.upper()]}' from `cog_kwargs`."
+            )
+
+    return merge_warp_options(options, creation_options)
+
+
+def write_cog(inp_path, out_path, *, cog_kwargs=None, creation_options=()):
+    """Write `inp_path` as a Cloud-Optimized GeoTIFF.
+
+    Uses the COG driver (GDAL >= 3.1) when available. Otherwise, writes a tiled
+    GeoTIFF and builds internal overviews in it. That isn't strictly a COG,
+    since the overviews follow the full-resolution data, but avoids writing
+    the raster twice.
+    """
+    cog_kwargs = {**COG_DEFAULTS, **(cog_kwargs or {})}
+    cog_driver = bool(gdal.GetDriverByName('COG'))
+    options = _cog_creation_options(cog_kwargs,
+                                    cog_driver=cog_driver,
+                                    creation_options=creation_options)
+
+    if cog_driver:
+        gdal.Translate(out_path, inp_path, format='COG', creationOptions=options)
+        return
+
+    gdal.Translate(out_path, inp_path, format='GTiff', creationOptions=options)
+
+    ds = gdal.Open(out_path, gdal.GA_Update)
+    with gdal_config_options(COMPRESS_OVERVIEW=cog_kwargs['compress']):
+        result = ds.BuildOverviews(
+            cog_kwargs['resampling'].upper(),
+            overview_levels(ds.RasterXSize, ds.RasterYSize,
+                            min_size=cog_kwargs['blocksize']),
+        )
+    # Flush the overviews to disk.
+    del ds
+
+    if result != 0:
+        raise RuntimeError(f'Failed to build overviews for {out_path}.')
+
+
+def _source_window(ds, bounds, *, geographic):
+    """Return the pixel window `[xoff, yoff, xsize, ysize]` covering `bounds`.
+
+    Returns None if the window can't be computed or is the whole raster.
+    """
+    x0, x_res, x_rot, y0, y_rot, y_res = ds.GetGeoTransform()
+    if x_rot or y_rot:
+        return None
+
+    x_end = x0 + x_res * ds.RasterXSize
+    if geographic and (min(x0, x_end) < -180 or max(x0, x_end) > 180):
+        # E.g. longitudes 0 to 360; the bounds don't map to one window.
+        return None
+
+    xmin, ymin, xmax, ymax = bounds
+    cols = sorted(((xmin - x0) / x_res, (xmax - x0) / x_res))
+    rows = sorted(((ymin - y0) / y_res, (ymax - y0) / y_res))
+    xoff = max(0, math.floor(cols[0]))
+    yoff = max(0, math.floor(rows[0]))
+    xend = min(ds.RasterXSize, math.ceil(cols[1]))
+    yend = min(ds.RasterYSize, math.ceil(rows[1]))
+
+    if xend <= xoff or yend <= yoff:
+        return None
+    if (xoff, yoff, xend, yend) == (0, 0, ds.RasterXSize, ds.RasterYSize):
+        return None
+
+    return [xoff, yoff, xend - xoff, yend - yoff]
+
+
+def _crop_to_output_bounds(inp_path, crop_path, *, src_srs, output_bounds):
+    """Write a VRT of the part of `inp_path` needed to warp to `output_bounds`.
+
+    `output_bounds` are in the project CRS. They are transformed, with a
+    margin, to the source SRS, and the VRT is cropped to the whole source
+    pixels covering them. Returns False if no cropping is possible.
+    """
+    xmin, ymin, xmax, ymax = output_bounds
+    extent = {'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax}
+    try:
+        bounds = transform_extent(extent,
+                                  from_crs=CONFIG['project']['crs'],
+                                  to_crs=src_srs)
+    except pyproj.exceptions.CRSError as e:
+        logger.info(f'Not cropping {inp_path}: {e}')
+        return False
+
+    if bounds is None:
+        return False
+
+    ds = gdal.Open(inp_path, GA_ReadOnly)
+    src_win = _source_window(
+        ds, bounds,
+        geographic=pyproj.CRS.from_user_input(src_srs).is_geographic,
+    )
+    if src_win is None:
+        return False
+
+    logger.info(
+        f'Cropping {inp_path} to {src_win[2]}x{src_win[3]} of'
+        f' {ds.RasterXSize}x{ds.RasterYSize} pixels before warping.'
+    )
+    gdal.Translate(crop_path, ds, format='VRT', srcWin=src_win)
+
+    return True
+
+
+def _warp(inp_path, out_path, *, layer_cfg, warp_kwargs, cog_kwargs):
+    project_crs = CONFIG['project']['crs']
+    if cog_kwargs is None:
+        gdal.Warp(out_path, inp_path, dstSRS=project_crs, **warp_kwargs)
+        return
+
+    # Warp lazily to an in-memory VRT, then write the COG from that in a
+    # single pass. The layer's creation options apply to the COG.
+    creation_options = warp_kwargs.pop('creationOptions', ())
+    vrt_path = f"/vsimem/{layer_cfg['id']}_warped.vrt"
+    gdal.Warp(vrt_path, inp_path, dstSRS=project_crs, format='VRT',
+              **warp_kwargs)
+    try:
+        write_cog(vrt_path, out_path,
+                  cog_kwargs=cog_kwargs,
+                  creation_options=creation_options)
+    finally:
+        gdal.Unlink(vrt_path)
+
+
+def warp_raster(inp_path, out_path, *, layer_cfg, warp_kwargs=None,
+                cog_kwargs=None):
     logger.info(f"Reprojecting {layer_cfg['id']}...")
 
-    if not warp_kwargs:
-        warp_kwargs = {}
+    warp_kwargs = dict(warp_kwargs or {})
+    # Not a `gdal.Warp` argument; the size (in MB) of GDAL's block cache while
+    # warping.
+    cache_max = warp_kwargs.pop('GDAL_CACHEMAX', None)
 
     srs_str = _get_raster_srs(inp_path)
     logger.info(f'Detected projection: {srs_str}')
@@ -56,28 +283,24 @@ def warp_raster(inp_path, out_path, *, layer_cfg, warp_kwargs=None):
                            'No projection automatically detected and '
                            'none explicitly provided.')
 
-    project_crs = CONFIG['project']['crs']
     logger.debug(f'Warping with arguments: {warp_kwargs}')
-    logger.info(f'Target projection: {project_crs}')
-    gdal.Warp(out_path, inp_path, dstSRS=project_crs, **warp_kwargs)
-
-
-def gdal_calc_raster(in_filepath, out_filepath, *, layer_cfg, gdal_calc_kwargs):
-    cmd_args_list = []
-    for k, v in gdal_calc_kwargs.items():
-        cmd_args_list.append(f'--{k}={v}')
+    logger.info(f"Target projection: {CONFIG['project']['crs']}")
 
-    cmd_args_str = ' '.join(cmd_args_list)
+    # Only read the part of the source which covers the output, e.g. the
+    # Arctic from a global raster.
+    crop_path = f"/vsimem/{layer_cfg['id']}_cropped.vrt"
+    if 'outputBounds' in warp_kwargs and _crop_to_output_bounds(
+        inp_path, crop_path,
+        src_srs=srs_str,
+        output_bounds=warp_kwargs['outputBounds'],
+    ):
+        inp_path = crop_path
 
-    cmd = (f'. activate base && gdal_calc.py {cmd_args_str}'
-           f' -A {in_filepath} --outfile={out_filepath}')
-    logger.debug(f'Executing gdal_calc command: {cmd}')
-
-    # TODO: util func for running external cmd.
-    result = subprocess.run(cmd,
-                            shell=True,
-                            executable='/bin/bash',
-                            capture_output=True)
-
-    if result.returncode != 0:
-        raise RuntimeError(result.stderr)
+    try:
+        with gdal_cache_max(cache_max):
+            _warp(inp_path, out_path,
+                  layer_cfg=layer_cfg,
+                  warp_kwargs=warp_kwargs,
+                  cog_kwargs=cog_kwargs)
+    finally:
+        gdal.Unlink(crop_path)
@@ -0,0 +1,183 @@
+"""Evaluate gdal_calc.py-style expressions in-process, block by block.
+
+Mirrors the `gdal_calc.py` options we use (`calc`, `type`, `NoDataValue`) and
+its defaults: the output type is the largest input type, and pixels which are
+nodata in any input are nodata in the output.
+"""
+
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import rasterio as rio
+
+logger = logging.getLogger('luigi-interface')
+
+# Output nodata values `gdal_calc.py` uses when none is given.
+DEFAULT_NODATA = {
+    'uint8': 255,
+    'uint16': 65535,
+    'int16': -32767,
+    'uint32': 4294967293,
+    'int32': -2147483647,
+    'float32': 3.402823466e+38,
+    'float64': 1.7976931348623158e+308,
+}
+
+# GDAL data types, in the order `gdal_calc.py` uses to pick the largest input
+# type for the output. Not numpy's promotion: uint16 and int16 give int16.
+_GDAL_TYPE_ORDER = (
+    'uint8', 'uint16', 'int16', 'uint32', 'int32', 'float32', 'float64',
+)
+
+# Like `gdal_calc.py`, expressions can use numpy functions unqualified.
+_CALC_NAMESPACE = {
+    '__builtins__': {},
+    'np': np,
+    'numpy': np,
+    **{name: getattr(np, name) for name in dir(np) if not name.startswith('_')},
+}
+
+
+def _numpy_dtype(gdal_type):
+    """Convert a GDAL type name (e.g. 'Float32') to a numpy dtype name."""
+    if gdal_type.lower() == 'byte':
+        return 'uint8'
+
+    dtype = gdal_type.lower()
+    if dtype not in DEFAULT_NODATA:
+        raise RuntimeError(f"Unsupported output type '{gdal_type}'.")
+
+    return dtype
+
+
+class _ThreadDatasets(threading.local):
+    """Datasets opened once per thread; rasterio datasets aren't thread-safe."""
+
+    def __init__(self, input_fps, all_opened):
+        # Called in each thread with the same arguments, so `all_opened` is
+        # shared.
+        self.input_fps = input_fps
+        self.all_opened = all_opened
+
+    def get(self):
+        if not hasattr(self, 'datasets'):
+            self.datasets = {
+                name: rio.open(fp) for name, fp in self.input_fps.items()
+            }
+            self.all_opened.extend(self.datasets.values())
+
+        return self.datasets
+
+
+def _output_dtype(datasets, output_type):
+    if output_type:
+        return _numpy_dtype(output_type)
+
+    input_dtypes = {ds.dtypes[0] for ds in datasets.values()}
+    unsupported = input_dtypes - set(_GDAL_TYPE_ORDER)
+    if unsupported:
+        raise RuntimeError(
+            f'Unsupported input types {sorted(unsupported)}; set output_type.'
+        )
+
+    return max(input_dtypes, key=_GDAL_TYPE_ORDER.index)
+
+
+def _check_same_grid(datasets):
+    first, *rest = datasets.values()
+    for ds in rest:
+        if (ds.shape, ds.transform) != (first.shape, first.transform):
+            raise RuntimeError(
+                f'Input {ds.name} is not on the same grid as {first.name}.'
+            )
+
+
+def _calc_block(datasets, window, *, expression, dtype, nodata):
+    arrays = {
+        name: ds.read(1, window=window, masked=True)
+        for name, ds in datasets.items()
+    }
+    mask = np.logical_or.reduce(
+        [np.ma.getmaskarray(array) for array in arrays.values()]
+    )
+
+    namespace = {name: array.data for name, array in arrays.items()}
+    with np.errstate(all='ignore'):
+        result = eval(expression, _CALC_NAMESPACE, namespace)
+
+    result = np.broadcast_to(result, mask.shape).astype(dtype)
+    result[mask] = nodata
+
+    return result
+
+
+def _write_blocks(out_ds, executor, calc_block, windows, *, max_pending):
+    """Write blocks to `out_ds` in order, computing them with `executor`."""
+    pending = deque()
+    for window in windows:
+        pending.append((window, executor.submit(calc_block, window)))
+        # Bound the number of computed blocks held in memory.
+        if len(pending) >= max_pending:
+            done_window, future = pending.popleft()
+            out_ds.write(future.result(), 1, window=done_window)
+
+    for done_window, future in pending:
+        out_ds.write(future.result(), 1, window=done_window)
+
+
+def calc_raster(input_fps, out_fp, *, calc, output_type=None, nodata=None,
+                max_workers=None):
+    """Evaluate expression `calc` over the rasters in `input_fps`.
+
+    `input_fps` maps the names used in `calc` (e.g. 'A') to raster paths. All
+    inputs must be on the same grid. Only the first band of each is used.
+
+    The output is computed one block of the first input at a time by a pool of
+    threads, and written in order from the calling thread, so memory use does
+    not grow with raster size.
+    """
+    try:
+        expression = compile(calc, '<calc>', 'eval')
+    except SyntaxError as e:
+        raise RuntimeError(f"Invalid calc expression '{calc}': {e}")
+
+    max_workers = max_workers or os.cpu_count()
+    all_opened = []
+    thread_datasets = _ThreadDatasets(input_fps, all_opened)
+    try:
+        datasets = thread_datasets.get()
+        _check_same_grid(datasets)
+
+        dtype = _output_dtype(datasets, output_type)
+        if nodata is None:
+            nodata = DEFAULT_NODATA[dtype]
+
+        first = next(iter(datasets.values()))
+        profile = {
+            **first.profile,
+            'driver': 'GTiff',
+            'count': 1,
+            'dtype': dtype,
+            'nodata': nodata,
+            'compress': 'deflate',
+        }
+        windows = [window for _, window in first.block_windows(1)]
+
+        def calc_block(window):
+            return _calc_block(thread_datasets.get(), window,
+                               expression=expression,
+                               dtype=dtype,
+                               nodata=nodata)
+
+        logger.info(f'Calculating {calc} over {len(windows)} blocks...')
+        with rio.open(out_fp, 'w', **profile) as out_ds, \
+                ThreadPoolExecutor(max_workers=max_workers) as executor:
+            _write_blocks(out_ds, executor, calc_block, windows,
+                          max_pending=max_workers * 2)
+    finally:
+        for ds in all_opened:
+            ds.close()
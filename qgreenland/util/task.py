@@ -1,5 +1,14 @@
+from luigi.task_register import Register
+
 from qgreenland.constants import CONFIG
+from qgreenland.tasks.common.misc import Decompress, ExtractNcDataset
 from qgreenland.tasks.layers import INGEST_TASKS
+from qgreenland.util.luigi import count_task_references
+
+# Tasks keyed by data source rather than by layer. Other tasks can also be
+# required more than once (e.g. a layer required by the project file and the
+# zip), but sharing those saves no work.
+SOURCE_TASK_TYPES = (Decompress, ExtractNcDataset)
 
 
 def generate_layer_tasks():
@@ -20,3 +29,28 @@ def generate_layer_tasks():
         tasks.append(task(layer_id=cfg['id']))
 
     return tasks
+
+
+def shared_task_report():
+    """Summarize the source tasks shared between layer pipelines, by family.
+
+    Tasks keyed by data source (see `SOURCE_TASK_TYPES`) are required by
+    every layer using that source, but only run once.
+    """
+    references, unique = count_task_references(generate_layer_tasks())
+    families = sorted(
+        family for family in references
+        if issubclass(Register.get_task_cls(family), SOURCE_TASK_TYPES)
+    )
+
+    lines = [f"{'Task':<28}{'Required':>10}{'Unique':>10}{'Shared':>10}"]
+    for family in families:
+        shared = references[family] - unique[family]
+        lines.append(
+            f'{family:<28}{references[family]:>10}{unique[family]:>10}{shared:>10}'
+        )
+
+    total_shared = sum(references[f] - unique[f] for f in families)
+    lines.append(f'{total_shared} redundant stages eliminated.')
+
+    return '\n'.join(lines)
@@ -1,42 +1,164 @@
 import logging
-import subprocess
+import shlex
+import time
 
-import geopandas
+import pyproj
+from osgeo import gdal
+
+from qgreenland.constants import CONFIG
+from qgreenland.util.extent import transform_extent
+from qgreenland.util.gdal import gdal_config_options
 
 
 logger = logging.getLogger('luigi-interface')
 
 
-def filter_vector(vector_path, *, filter_func):
-    gdf = geopandas.read_file(vector_path)
+class Ogr2OgrError(RuntimeError):
+    """An `ogr2ogr` translation failed. `errors` holds GDAL's messages."""
+
+    def __init__(self, in_filepath, ogr2ogr_args, errors):
+        super().__init__(in_filepath, ogr2ogr_args, errors)
+        self.in_filepath = in_filepath
+        self.ogr2ogr_args = ogr2ogr_args
+        self.errors = errors
+
+    def __str__(self):
+        return (
+            f'ogr2ogr failed for {self.in_filepath} with arguments'
+            f" {self.ogr2ogr_args}: {'; '.join(self.errors) or 'unknown error'}"
+        )
+
+
+def ogr2ogr_args(**ogr2ogr_kwargs):
+    """Convert keyword arguments to a list of `ogr2ogr` command-line arguments.
+
+    Each value is split like shell arguments, so e.g. a `clipdst` of
+    `'"0" "0" "1" "1"'` becomes four arguments. An empty value is a flag.
+    """
+    args = []
+    for k, v in ogr2ogr_kwargs.items():
+        args.append(f'-{k}')
+        args.extend(shlex.split(str(v)))
+
+    return args
+
+
+def get_vector_srs(fp):
+    """Return the SRS of the first layer of vector file `fp`, or None."""
+    ds = gdal.OpenEx(str(fp), gdal.OF_VECTOR)
+    if ds is None:
+        return None
+
+    layer = ds.GetLayer(0)
+    srs = layer.GetSpatialRef() if layer else None
+
+    return srs.ExportToWkt() if srs else None
+
+
+def extent_filter_kwargs(in_filepath, *, extent, s_srs=None):
+    """Return `ogr2ogr` kwargs to only read features near the project `extent`.
 
-    gdf = gdf.loc[filter_func]
-    return gdf
+    The extent is transformed to the source's SRS (`s_srs`, if it overrides
+    the SRS in the file) and applied as a spatial filter (`-spat`), so
+    features far outside the project area are never reprojected. Returns no
+    kwargs if the source's SRS is unknown.
+    """
+    source_srs = s_srs or get_vector_srs(in_filepath)
+    if not source_srs:
+        logger.info(f'No SRS found for {in_filepath}; not filtering by extent.')
+        return {}
+
+    try:
+        bounds = transform_extent(extent,
+                                  from_crs=CONFIG['project']['crs'],
+                                  to_crs=source_srs)
+    except pyproj.exceptions.CRSError as e:
+        logger.info(f'Not filtering {in_filepath} by extent: {e}')
+        return {}
+
+    if bounds is None:
+        return {}
+
+    return {'spat': ' '.join(str(coord) for coord in bounds)}
+
+
+def _vector_translate(in_filepath, out_filepath, args, *, config_options=None):
+    logger.debug(f'Running ogr2ogr on {in_filepath} with arguments: {args}')
+
+    errors = []
+
+    def error_handler(err_class, _err_num, msg):
+        if err_class >= gdal.CE_Failure:
+            errors.append(msg)
+        elif err_class == gdal.CE_Warning:
+            logger.warning(f'ogr2ogr: {msg}')
+
+    start = time.monotonic()
+    gdal.PushErrorHandler(error_handler)
+    try:
+        with gdal_config_options(**(config_options or {})):
+            ds = gdal.VectorTranslate(out_filepath, in_filepath, options=args)
+            # Flush the output to disk.
+            succeeded = ds is not None
+            del ds
+    finally:
+        gdal.PopErrorHandler()
+
+    if not succeeded:
+        raise Ogr2OgrError(in_filepath, args, errors)
+
+    # Like the `ogr2ogr` command, errors that didn't stop the translation
+    # (e.g. a feature that couldn't be reprojected) aren't fatal.
+    for msg in errors:
+        logger.warning(f'ogr2ogr: {msg}')
+
+    logger.info(f'ogr2ogr wrote {out_filepath} in'
+                f' {time.monotonic() - start:.2f}s.')
 
 
 def ogr2ogr(in_filepath, out_filepath, **ogr2ogr_kwargs):
-    cmd_args_list = []
-    cmd_prefix = ''
+    """Run the equivalent of the `ogr2ogr` command in this process.
+
+    Keyword arguments are `ogr2ogr` options without the leading `-`.
+    """
+    config_options = {}
     if 'OGR_ENABLE_PARTIAL_REPROJECTION' in ogr2ogr_kwargs.keys():
         enable_partial_reprojection = ogr2ogr_kwargs.pop(
             'OGR_ENABLE_PARTIAL_REPROJECTION'
         )
-        cmd_prefix = f'OGR_ENABLE_PARTIAL_REPROJECTION={enable_partial_reprojection}'
+        config_options['OGR_ENABLE_PARTIAL_REPROJECTION'] = str(
+            enable_partial_reprojection
+        ).upper()
 
-    for k, v in ogr2ogr_kwargs.items():
-        cmd_args_list.append(f'-{k} {v}')
+    _vector_translate(in_filepath, out_filepath,
+                      ogr2ogr_args(**ogr2ogr_kwargs),
+                      config_options=config_options)
+
+
+def filter_args(*, where=None, bbox=None, select=None):
+    """Convert `filter_kwargs` to `ogr2ogr` command-line arguments."""
+    args = []
+    if where:
+        args += ['-where', where]
+    if bbox:
+        args += ['-spat', *(str(coord) for coord in bbox)]
+    if select:
+        args += ['-select', ','.join(select)]
 
-    cmd_args_str = ' '.join(cmd_args_list)
+    return args
 
-    cmd = (f'. activate gdal && {cmd_prefix} ogr2ogr {cmd_args_str}'
-           f' {out_filepath} {in_filepath}')
-    logger.debug(f'Executing ogr2ogr command: {cmd}')
-    result = subprocess.run(cmd,
-                            shell=True,
-                            executable='/bin/bash',
-                            capture_output=True)
 
-    if result.returncode != 0:
-        raise RuntimeError(result.stderr)
+def filter_vector(in_filepath, out_filepath, *, filter_kwargs,
+                  **ogr2ogr_kwargs):
+    """Copy the features of `in_filepath` which match `filter_kwargs`.
 
-    return result
+    The filters are applied by the OGR reader, so non-matching features and
+    unselected columns are never loaded. Features are streamed to the output,
+    committed in large transactions.
+    """
+    args = [
+        *ogr2ogr_args(**ogr2ogr_kwargs),
+        *filter_args(**filter_kwargs),
+        '-gt', '65536',
+    ]
+    _vector_translate(in_filepath, out_filepath, args)
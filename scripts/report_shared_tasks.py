@@ -0,0 +1,13 @@
+"""Reports how many pipeline stages are shared between layers."""
+
+# Hack to import from qgreenland
+import os, sys
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+PARENT_DIR = os.path.dirname(THIS_DIR)
+sys.path.insert(0, PARENT_DIR)
+
+
+from qgreenland.util.task import shared_task_report
+
+if __name__ == '__main__':
+    print(shared_task_report())
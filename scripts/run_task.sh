@@ -1,10 +1,6 @@
-# TODO: --workers=$(nproc)  (or more?)
-# Currently hardcoded to 1 because increasing number of workers leads to failures:
+# Runs the whole pipeline with one worker per CPU by default. Override the
+# worker count with e.g. `WORKERS=4 . run_task.sh`.
 #
-#    File "/luigi/tasks/qgreenland/util/qgis.py", line 87, in get_map_layer
-#        raise RuntimeError(f"Layer located at '{layer_path}' does not exist.")
-#        RuntimeError: Layer located at '/luigi/data/luigi-wip/qgreenland/Geophysics/IceBridge BedMachine/bedmachine_bed/bedmachine_bed.tif' does not exist.
-
 # NOTE: Workers must be set to 1 for python debug breakpoints to be usable
-docker-compose exec luigi luigi --workers=1 \
+docker-compose exec luigi luigi --workers=${WORKERS:-$(nproc)} \
   --module qgreenland.tasks.main ZipQGreenland
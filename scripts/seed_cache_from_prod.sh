@@ -2,14 +2,23 @@
 
 LOCAL_CACHE_DIR='/share/appdata/qgreenland-input-cache/'
 PROD_CACHE_DIR='/share/appdata/qgreenland-input-cache/'
+# Built layers, keyed by fingerprint. See `qgreenland.util.build_cache`.
+LOCAL_BUILD_CACHE_DIR='/share/appdata/qgreenland-build-cache/'
+PROD_BUILD_CACHE_DIR='/share/appdata/qgreenland-build-cache/'
 PROD_HOSTNAME='qgreenland.apps.int.nsidc.org'
 VAGRANT_SSH_KEY='~/.ssh/id_rsa_vagrant_vsphere'
 
-if [ ! -w ${LOCAL_CACHE_DIR} ]; then
-    echo "${LOCAL_CACHE_DIR} must be writable to continue."
-    exit 1
-fi
+for dir in ${LOCAL_CACHE_DIR} ${LOCAL_BUILD_CACHE_DIR}; do
+    if [ ! -w ${dir} ]; then
+        echo "${dir} must be writable to continue."
+        exit 1
+    fi
+done
 
 rsync -a --progress --verbose \
     -e "ssh -i ${HOME}/.ssh/id_rsa_vagrant_vsphere" \
     vagrant@${PROD_HOSTNAME}:${PROD_CACHE_DIR} ${LOCAL_CACHE_DIR}
+# Entries are never modified once written, so existing ones can be skipped.
+rsync -a --progress --verbose --ignore-existing \
+    -e "ssh -i ${HOME}/.ssh/id_rsa_vagrant_vsphere" \
+    vagrant@${PROD_HOSTNAME}:${PROD_BUILD_CACHE_DIR} ${LOCAL_BUILD_CACHE_DIR}